@@ -1,20 +1,26 @@
-from flask import Flask, request, render_template, send_from_directory, url_for, request
+from flask import Flask, request, render_template, send_from_directory, url_for, jsonify
 from flask_socketio import SocketIO, emit
 from tqdm import tqdm
 from werkzeug.utils import secure_filename
 import os
+import time
 import shutil
-from pydub import AudioSegment
-import random
+from itertools import islice
+from contextlib import nullcontext
 import librosa
-import numpy as np
+import soundfile as sf
 import imageio
-from matplotlib import cm
 
 from fastai.vision.all import *
 
-from huggingface_hub import hf_hub_url, hf_hub_download
-from fastai.learner import load_learner
+from src.app.model_manager import model_manager_from_env
+from src.models.predict_model import ScriptedModel
+from src.app.pipeline import SegmentPipeline, stream_segments
+from src.app.chunked_upload import ChunkedUpload, UploadAborted
+from src.app.metrics import RequestTimer, LatencyStats, profiled
+from src.app.inference import InferenceService
+from src.app.prediction_cache import PredictionCache, segment_key
+from src.features.spectrogram import SPECTROGRAM_PARAMS, normalized_log_mel, colorize, batched
 
 
 app = Flask(__name__)
@@ -36,62 +42,247 @@ def ensure_dir_exists(dir_path):
         os.makedirs(dir_path)
         
 ensure_dir_exists(upload_folder)
+
+# Uploads are decoded once into memory at this rate and split into segments from there
+SAMPLE_RATE = 44100
+SEGMENT_LENGTH = 3 # seconds
+
+# Also write every segment to <session>/segments as a WAV file, only needed for debugging
+app.config['WRITE_SEGMENTS'] = False
+
+# Decode, extract features and predict in concurrent stages, off the Socket.IO handler
+app.config['PIPELINED'] = True
+
+# Running pipeline of each session, stopped when the session uploads a new song or disconnects
+active_pipelines = {}
+
+# Chunked upload of each session that is still arriving, as (upload, timer, profile)
+active_uploads = {}
+
+# Size of the chunks the page sends, the server takes any size up to max_http_buffer_size
+app.config['UPLOAD_CHUNK_SIZE'] = 512 * 1024
+
+# Per-stage timings of the last finished uploads, served by /stats
+upload_stats = LatencyStats()
+
+# Set by POST /stats/profile, the next upload then runs under cProfile and the profile is
+# written to PROFILE_DIR
+app.config['PROFILE_NEXT_UPLOAD'] = False
+app.config['PROFILE_DIR'] = os.path.join(os.path.dirname(project_dir), 'reports', 'profiles')
     
 socketio = SocketIO(app, logger=True, engineio_logger=True, max_http_buffer_size=1e8)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'wav', 'mp3', 'flac', 'ogg', 'm4a'}
 
-def convert_to_wav(file_path):
-    audio = AudioSegment.from_file(file_path)
-    wav_path = file_path.rsplit('.', 1)[0] + '.wav'
-    audio.export(wav_path, format="wav")
-    return wav_path
-
 @socketio.on('disconnect')
 def handle_disconnect():
     session_id = request.sid
+    stop_pipeline(session_id)
     session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
     clear_directory(session_dir)
     os.rmdir(session_dir)
 
 @socketio.on('song_uploaded')
 def handle_song_upload(message):
-    
+    # The whole song in one message, see upload_start for the chunked protocol the page uses
     session_id = request.sid
-    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    timer = RequestTimer(session_id)
 
     print("Received song upload message")
-
-    # Clear existing files in the upload folder
-    clear_directory(session_dir)
+    
+    static_path = new_upload_session(session_id)
+    session_dir = os.path.dirname(static_path)
 
     # Proceed with saving the new song
     filename = secure_filename(message['filename'])
     path_to_audio = os.path.join(session_dir, filename)
-    save_file(path_to_audio, message['song_data'])
+    with timer.stage('save'):
+        save_file(path_to_audio, message['song_data'])
+    
+    # The browser plays the uploaded file as is
+    song_url = request.host_url + 'uploads/' + session_id + '/' + filename
     
-    # Convert to wav if necessary
-    if not filename.rsplit('.', 1)[1].lower() == 'wav':
-        path_to_audio = convert_to_wav(path_to_audio)
-        filename = filename.rsplit('.', 1)[0] + '.wav'
+    # cProfile only sees the thread it runs in, so a profiled upload skips the pipeline and runs
+    # every stage here in the handler
+    profile = app.config['PROFILE_NEXT_UPLOAD']
+    app.config['PROFILE_NEXT_UPLOAD'] = False
     
-    segment_length = 3 # seconds
-    split_song(session_dir, path_to_audio, segment_length * 1000)
+    if app.config['PIPELINED'] and not profile:
+        emit('song_ready', {'song_url': song_url})
+        static_url = url_for('uploaded_file', session_id=session_id, filename='static/')
+        segments = stream_segments(path_to_audio, sr=SAMPLE_RATE, segment_length=SEGMENT_LENGTH)
+        start_pipeline(session_id, segments, static_path, static_url, timer)
+        return
     
+    analyze_song(session_id, path_to_audio, song_url, static_path, timer, profile)
+
+@socketio.on('upload_start')
+def handle_upload_start(message):
+    # Chunked upload: upload_start with the file name and its size in bytes, then upload_chunk
+    # messages with the sequence numbers 0, 1, ... and their bytes, then upload_end. Every message is
+    # acknowledged with the sequence number the server expects next, or with an error.
+    # The chunks are appended to the session's file as they arrive, and in pipelined mode the
+    # segments are decoded and predicted from the part of the file that is already there
+    session_id = request.sid
+    timer = RequestTimer(session_id)
+
+    print("Received song upload start")
+
+    static_path = new_upload_session(session_id)
+    filename = secure_filename(message['filename'])
+    path_to_audio = os.path.join(os.path.dirname(static_path), filename)
+    upload = ChunkedUpload(path_to_audio, int(message['size']))
+
+    profile = app.config['PROFILE_NEXT_UPLOAD']
+    app.config['PROFILE_NEXT_UPLOAD'] = False
+    active_uploads[session_id] = (upload, timer, profile)
+
+    if app.config['PIPELINED'] and not profile:
+        static_url = url_for('uploaded_file', session_id=session_id, filename='static/')
+        start_pipeline(session_id, upload_segments(upload), static_path, static_url, timer)
+    return {'next_seq': upload.next_seq}
+
+@socketio.on('upload_chunk')
+def handle_upload_chunk(message):
+    if request.sid not in active_uploads:
+        return {'error': "No upload in progress"}
+    upload, timer, _ = active_uploads[request.sid]
+    try:
+        with timer.stage('save'):
+            next_seq = upload.append(int(message['seq']), message['data'])
+    except TypeError as e:
+        emit('upload_error', {'message': str(e)})
+        return {'error': str(e)}
+    except (ValueError, UploadAborted) as e:
+        return {'error': str(e)}
+    return {'next_seq': next_seq}
+
+@socketio.on('upload_end')
+def handle_upload_end(message=None):
+    session_id = request.sid
+    if session_id not in active_uploads:
+        return {'error': "No upload in progress"}
+    upload, timer, profile = active_uploads[session_id]
+    try:
+        upload.finish()
+    except ValueError as e:
+        return {'error': str(e)}
+    del active_uploads[session_id]
+
+    # The browser plays the uploaded file as is, once all of it is there
+    filename = os.path.basename(upload.path)
     song_url = request.host_url + 'uploads/' + session_id + '/' + filename
-    emit('song_ready', {'song_url': song_url})
+    static_path = os.path.join(os.path.dirname(upload.path), 'static')
+
+    if app.config['PIPELINED'] and not profile:
+        emit('song_ready', {'song_url': song_url})
+    else:
+        analyze_song(session_id, upload.path, song_url, static_path, timer, profile)
+    return {'next_seq': upload.next_seq}
+
+def new_upload_session(session_id):
+    # Stops what the session was doing and clears its files, returns the directory for its spectrograms
+    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    os.makedirs(session_dir, exist_ok=True)
+    
+    stop_pipeline(session_id)
+
+    # Clear existing files in the upload folder
+    clear_directory(session_dir)
     
     static_path = os.path.join(session_dir,'static')
     
     ensure_dir_exists(static_path)
+    return static_path
+
+def upload_segments(upload):
+    # Segments of a chunked upload, decoded while the rest of the file is still arriving
+    with upload.reader() as reader:
+        yield from stream_segments(reader, sr=SAMPLE_RATE, segment_length=SEGMENT_LENGTH)
+
+def analyze_song(session_id, path_to_audio, song_url, static_path, timer, profile=False):
+    # Every stage in the handler, one after the other, used when the pipeline is off or the upload is profiled
+    with profiled(app.config['PROFILE_DIR'], f"upload_{int(time.time())}_{session_id}") if profile else nullcontext():
+        # Decode the song once, the segments are views into this buffer
+        with timer.stage('decode'):
+            song = decode_song(path_to_audio, sr=SAMPLE_RATE)
+        
+        if app.config['WRITE_SEGMENTS']:
+            with timer.stage('write_segments'):
+                split_song(os.path.dirname(static_path), song, SAMPLE_RATE, SEGMENT_LENGTH)
+        
+        emit('song_ready', {'song_url': song_url})
+        
+        generate_and_predict_spectrograms(iter_segments(song, SAMPLE_RATE, SEGMENT_LENGTH), static_path, session_id,
+                                          timer=timer)
+    upload_stats.record(timer)
+
+def start_pipeline(session_id, segments, static_path, static_url, timer, batch_size=16):
+    # segments yields (index, audio) while the song is decoded
+    segments = timer.timed_iter('decode', segments)
+    
+    if app.config['WRITE_SEGMENTS']:
+        session_dir = os.path.dirname(static_path)
+        segments = write_segments(session_dir, segments, SAMPLE_RATE, timer=timer)
+    
+    def featurize(segment_index, y):
+        # Save spectrogram, only for display on the client, the model gets the array in memory
+        spec_filename = f"segment_{segment_index}_spectrogram.png"
+        spec_path = os.path.join(static_path, spec_filename)
+        key = cache_key(y)
+        with timer.stage('cache'):
+            prediction = prediction_cache.get(key, spec_path)
+        if prediction is not None:
+            return None, static_url + spec_filename, spec_path, key, prediction
+        
+        with timer.stage('spectrogram'):
+            colored_spec_rgb = segment_spectrogram(y, SAMPLE_RATE)
+        with timer.stage('write_png'):
+            imageio.imwrite(spec_path, colored_spec_rgb)
+        return colored_spec_rgb, static_url + spec_filename, spec_path, key, None
+    
+    def predict(features):
+        # Only the segments that weren't in the cache go through the model
+        predictions = [feature[4] for feature in features]
+        misses = [i for i, prediction in enumerate(predictions) if prediction is None]
+        with timer.stage('predict'):
+            miss_predictions = inference_service.predict([features[i][0] for i in misses])
+        with timer.stage('cache'):
+            for i, prediction in zip(misses, miss_predictions):
+                predictions[i] = prediction
+                prediction_cache.put(features[i][3], prediction, features[i][2])
+        return predictions
+    
+    def on_result(segment_index, feature, prediction):
+        # Outside the handler there is no request context, so address the session explicitly
+        with timer.stage('emit'):
+            socketio.emit('prediction_ready', {'index': segment_index, 'prediction': prediction, 'spectrogram_url': feature[1]},
+                          to=session_id)
+        timer.result_sent()
     
-    generate_and_predict_spectrograms(os.path.join(session_dir, 'segments'), static_path, session_id)
+    def on_error(e):
+        socketio.emit('upload_error', {'message': str(e)}, to=session_id)
+    
+    pipeline = SegmentPipeline(segments, featurize, predict, on_result, batch_size=batch_size, on_error=on_error,
+                               on_done=lambda: upload_stats.record(timer))
+    active_pipelines[session_id] = pipeline.start()
+
+def stop_pipeline(session_id):
+    pipeline = active_pipelines.pop(session_id, None)
+    if pipeline is not None:
+        pipeline.stop()
+    # The decoder may be waiting for chunks of an unfinished upload, aborting it lets the decoder return
+    upload, _, _ = active_uploads.pop(session_id, (None, None, None))
+    if upload is not None:
+        upload.abort()
+    if pipeline is not None:
+        # Wait for the stages to let go of the session's files
+        pipeline.join()
     
 def save_file(file_path, song_data):
     print("Saving file to", file_path)
@@ -108,23 +299,32 @@ def save_file(file_path, song_data):
 def uploaded_file(session_id, filename):
     return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], session_id), filename)
 
-def split_song(session_dir, file_path, segment_length_ms):
+def decode_song(file_path, sr=44100):
+    # Decode and resample the whole file to a mono float32 buffer
+    y, _ = librosa.load(file_path, sr=sr, mono=True)
+    return y
+
+def iter_segments(y, sr, segment_length):
+    # Yields (index, segment) pairs, every segment is a view into y, nothing is copied
+    segment_samples = int(sr * segment_length)
+    for i, start in enumerate(range(0, len(y), segment_samples)):
+        yield i, y[start:start + segment_samples]
+
+def split_song(session_dir, y, sr, segment_length):
+    for _ in tqdm(write_segments(session_dir, iter_segments(y, sr, segment_length), sr), desc="Writing song segments"):
+        pass
+
+def write_segments(session_dir, segments, sr, timer=None):
+    # Writes each segment to <session>/segments as it passes through
     segment_dir = os.path.join(session_dir, 'segments')
     if not os.path.isdir(segment_dir):
         print("Creating directory", segment_dir)
         os.makedirs(segment_dir, exist_ok=True)
         
-    song = AudioSegment.from_wav(file_path)
-    num_segments = len(song) // segment_length_ms
-
-    progress_bar = tqdm(total=num_segments, desc="Splitting song into segments")
-
-    for i in range(0, len(song), segment_length_ms):
-        segment = song[i:i + segment_length_ms]
-        segment.export(os.path.join(segment_dir, f"segment_{i // segment_length_ms}.wav"), format="wav")
-        progress_bar.update(1)
-
-    progress_bar.close()
+    for i, segment in segments:
+        with timer.stage('write_segments') if timer is not None else nullcontext():
+            sf.write(os.path.join(segment_dir, f"segment_{i}.wav"), segment, sr)
+        yield i, segment
         
 
 def clear_directory(directory):
@@ -138,103 +338,149 @@ def clear_directory(directory):
         except Exception as e:
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
-def generate_and_predict_spectrograms(audio_dir, output_dir, session_id, sr=44100):
+def generate_and_predict_spectrograms(segments, output_dir, session_id, sr=44100, batch_size=16, timer=None):
+    # The stages are timed in timer, if one is given
+    timer = timer if timer is not None else RequestTimer(session_id)
+
     # Clear the output directory at the start of each call
     clear_directory(output_dir)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    audio_files = [f for f in os.listdir(audio_dir) if f.endswith('.wav')]
-
-    # Sort the audio files by the segment number
-    audio_files.sort(key=lambda f: int(f.split('_')[1].split('.')[0]))
-
-    for file in audio_files:
-        # Assuming the filename format is "segment_x.wav"
-        segment_index = file.split('_')[1].split('.')[0]
-
-        audio_path = os.path.join(audio_dir, file)
-        y, sr = librosa.load(audio_path, sr=sr, mono=True)
-
-        # Generate spectrogram for the audio segment
-        mel_spec = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, fmax=22000)
-        log_mel_spec = librosa.power_to_db(mel_spec, ref=np.max)
-        norm_log_mel_spec = (log_mel_spec - log_mel_spec.min()) / (log_mel_spec.max() - log_mel_spec.min())
-        colored_spec = cm.viridis(norm_log_mel_spec)
-        colored_spec_rgb = (colored_spec[..., :3] * 255).astype(np.uint8)
-
-        # Save spectrogram
-        spec_filename = f"segment_{segment_index}_spectrogram.png"
-        save_path = os.path.join(output_dir, spec_filename)
-        imageio.imwrite(save_path, colored_spec_rgb)
-
-        # Make a mock prediction on the spectrogram
-        #prediction = mock_predict_on_segment(save_path)
-        
-        prediction = predict_on_segment(save_path)
-        
-        spectrogram_url = url_for('uploaded_file', session_id=session_id, filename='static/' + spec_filename)
-
-        
-        # Emit prediction to the client
-        emit('prediction_ready', {'index': segment_index, 'prediction': prediction, 'spectrogram_url': spectrogram_url})
-
-
-def mock_predict_on_segment(segment_path):
-    # Add a short delay to simulate processing time
-    import time
-    time.sleep(1)
+    segments = iter(segments)
+
+    # Segments are processed batch_size at a time, so the first predictions reach the client
+    # before the spectrograms of the whole song are done
+    while True:
+        batch = list(islice(segments, batch_size))
+        if not batch:
+            break
+        segment_indices = []
+        spectrogram_urls = []
+        predictions = []
+        # (position in the batch, cache key, samples, image path) of the segments that weren't cached
+        misses = []
+
+        for segment_index, y in batch:
+            # Save spectrogram, only for display on the client, the model gets the array in memory
+            spec_filename = f"segment_{segment_index}_spectrogram.png"
+            save_path = os.path.join(output_dir, spec_filename)
+            key = cache_key(y, sr)
+            with timer.stage('cache'):
+                prediction = prediction_cache.get(key, save_path)
+            if prediction is None:
+                misses.append((len(predictions), key, y, save_path))
+
+            segment_indices.append(segment_index)
+            spectrogram_urls.append(url_for('uploaded_file', session_id=session_id, filename='static/' + spec_filename))
+            predictions.append(prediction)
+
+        if misses:
+            # Generate the spectrograms of the misses together, one STFT per stack of equal-length segments
+            with timer.stage('spectrogram'):
+                miss_spectrograms = batched([y for _, _, y, _ in misses], lambda ys: segment_spectrogram(ys, sr))
+            for (_, _, _, save_path), colored_spec_rgb in zip(misses, miss_spectrograms):
+                with timer.stage('write_png'):
+                    imageio.imwrite(save_path, colored_spec_rgb)
+
+            with timer.stage('predict'):
+                miss_predictions = inference_service.predict(miss_spectrograms)
+            with timer.stage('cache'):
+                for (position, key, _, save_path), prediction in zip(misses, miss_predictions):
+                    predictions[position] = prediction
+                    prediction_cache.put(key, prediction, save_path)
+
+        # Emit predictions to the client, in segment order
+        for segment_index, prediction, spectrogram_url in zip(segment_indices, predictions, spectrogram_urls):
+            with timer.stage('emit'):
+                emit('prediction_ready', {'index': segment_index, 'prediction': prediction, 'spectrogram_url': spectrogram_url})
+            timer.result_sent()
+
+
+def cache_key(y, sr=SAMPLE_RATE):
+    # The model version is part of the key, so the model has to be loaded first
+    model_manager.get()
+    return segment_key(y, sr, model_manager.version)
+
+
+def segment_spectrogram(y, sr=44100):
+    # Log-mel spectrogram of a segment (or a stack of equal-length segments), rendered as an RGB
+    # image by the same code as the training data
+    return colorize(normalized_log_mel(y, dict(SPECTROGRAM_PARAMS, sr=sr)))
+
+def predict_on_batch(spectrograms, batch_size=16):
+    learn = model_manager.get()
     
-    # Mock prediction logic as before, adapted for a single segment
-    print(f"Predicting on segment: {segment_path}")
-    num_predictions = random.randint(1, 10)
-    prediction = [random.choice(['drums', 'guitar', 'bass', 'vocals', 'synth', 'violin', 'tuba']) for _ in range(num_predictions)]
-    print("Prediction:", prediction)
-    return prediction
-
-def get_x(r): 
-    return r
-
-def get_y(r):
-    return null
-
-def predict_on_segment(segment_path):
+    # A TorchScript export does the resize and normalization itself
+    if isinstance(learn, ScriptedModel):
+        return [labels_from_probs(p, learn.vocab) for p in learn.predict_batch(spectrograms, batch_size=batch_size)]
+    
+    # Runs RGB spectrogram arrays through the model batch_size at a time. The learner's own
+    # test DataLoader applies the same resize and normalization as learn.predict
+    dl = learn.dls.test_dl(spectrograms, bs=batch_size, num_workers=0)
     
-    # Make a prediction
-    pred, _, probs = learn.predict(segment_path)
+    # Same activation learn.predict applies to the model output
+    activation = getcallable(learn.loss_func, 'activation')
     
+    learn.model.eval()
+    predictions = []
+    with torch.inference_mode():
+        for xb, in dl:
+            probs = activation(learn.model(xb))
+            predictions.extend(labels_from_probs(p, learn.dls.vocab) for p in probs)
+    
+    return predictions
+
+def labels_from_probs(probs, class_names):
     # Apply a threshold to convert probabilities to binary predictions
     threshold = 0.1
     binary_preds = (probs > threshold).numpy()
 
-    # Get the list of possible classes from the learner's data loaders
-    class_names = learn.dls.vocab
-
     # Filter class names based on the binary predictions
-    predicted_labels = [class_names[i] for i in range(len(class_names)) if binary_preds[i]]
-    
-    print("Predicted labels:", predicted_labels)
-    return predicted_labels
-
-# Load the pre-trained model
-
-# local
-#model_path = os.path.join(project_dir,'..','models', 'instrument_classifier3.pkl')
-#learn = load_learner(model_path)
-
-# Huggingface
-REPO = "gruppe11/audio-classifier"
-FILENAME = "instrument_classifier7.pkl"
-
-model_url = hf_hub_url(REPO, FILENAME)
-
-model_path = hf_hub_download(REPO, FILENAME)
-
-learn = load_learner(model_path)
-
-print("Model loaded: " + str(learn))
+    return [class_names[i] for i in range(len(class_names)) if binary_preds[i]]
+
+@app.route('/health')
+def health():
+    # Readiness of the model, 'ready' once it is loaded and warmed up
+    return jsonify(model_manager.status())
+
+@app.route('/stats')
+def stats():
+    # p50/p95/p99 of the total and per-stage latency of the last uploads, and segments per second
+    return jsonify(dict(upload_stats.summary(), inference=inference_service.stats(),
+                        cache=prediction_cache.stats()))
+
+@app.route('/stats/profile', methods=['POST'])
+def profile_next_upload():
+    # Profile the next upload with cProfile, the .prof file is written to PROFILE_DIR
+    app.config['PROFILE_NEXT_UPLOAD'] = True
+    return jsonify({'profile_next_upload': True, 'profile_dir': app.config['PROFILE_DIR']})
+
+# The pre-trained model is loaded on first use, or in the background when the server starts.
+# Set MODEL_PATH to load a local model, e.g. models/instrument_classifier3.pkl, instead of
+# the one in the Huggingface repo
+model_manager = model_manager_from_env()
+
+# Every session's segments go through this service, which batches segments of concurrent uploads
+# into one forward pass. INFERENCE_WORKERS sets how many batches run at the same time
+inference_service = InferenceService(predict_on_batch, max_batch=16, max_wait=0.02,
+                                     n_workers=int(os.environ.get('INFERENCE_WORKERS', 2)))
+
+# Threads of each forward pass, set when the server starts. By default the cores are split between
+# the inference workers instead of every forward pass using all of them
+app.config['TORCH_THREADS'] = int(os.environ.get('TORCH_THREADS',
+                                                 max(1, (os.cpu_count() or 1) // inference_service.n_workers)))
+
+# Predictions and spectrograms of segments seen before, keyed by the decoded samples and the model.
+# Kept across restarts in PREDICTION_CACHE_DIR, PREDICTION_CACHE_MB caps the size on disk
+app.config['PREDICTION_CACHE_DIR'] = os.environ.get('PREDICTION_CACHE_DIR',
+                                                    os.path.join(os.path.dirname(project_dir), 'data', 'cache', 'predictions'))
+prediction_cache = PredictionCache(app.config['PREDICTION_CACHE_DIR'],
+                                   max_bytes=int(os.environ.get('PREDICTION_CACHE_MB', 512)) * 2**20)
 
 if __name__ == '__main__':
     clear_directory(app.config['UPLOAD_FOLDER'])
+    torch.set_num_threads(app.config['TORCH_THREADS'])
+    model_manager.load_in_background()
     socketio.run(app, debug=True)
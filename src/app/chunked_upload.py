@@ -0,0 +1,115 @@
+import io
+import threading
+
+
+class UploadAborted(Exception):
+    pass
+
+
+class ChunkedUpload:
+    # A file that arrives in numbered chunks. Every chunk is appended to path as soon as it is
+    # received, so only one chunk is in memory at a time, and reader() gives file objects that read
+    # the part already on disk and wait for the rest. size is the size of the whole file, announced
+    # by the client before the first chunk
+    def __init__(self, path, size, timeout=60):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.received = 0
+        self.next_seq = 0
+        self.complete = False
+        self.aborted = False
+        self._cond = threading.Condition()
+        self._file = open(path, 'wb')
+
+    def append(self, seq, data):
+        # Returns the sequence number of the next chunk the upload expects. A chunk that is not
+        # the expected one is ignored, the client then resends from the returned number
+        if not isinstance(data, (bytes, bytearray)):
+            raise TypeError(f"Chunk {seq} is {type(data).__name__}, not bytes")
+        with self._cond:
+            if self.aborted or self.complete:
+                raise UploadAborted(f"Upload of {self.path} is closed")
+            if seq != self.next_seq:
+                return self.next_seq
+            if self.received + len(data) > self.size:
+                raise ValueError(f"Chunk {seq} goes past the announced size of {self.size} bytes")
+            self._file.write(data)
+            self._file.flush()
+            self.received += len(data)
+            self.next_seq += 1
+            self._cond.notify_all()
+            return self.next_seq
+
+    def finish(self):
+        with self._cond:
+            if self.received != self.size:
+                raise ValueError(f"Received {self.received} of {self.size} bytes")
+            self._file.close()
+            self.complete = True
+            self._cond.notify_all()
+
+    def abort(self):
+        # Readers waiting for more data raise UploadAborted
+        with self._cond:
+            if not self.complete:
+                self._file.close()
+            self.aborted = True
+            self._cond.notify_all()
+
+    def wait_for(self, n_bytes):
+        # Blocks until the first n_bytes are on disk, or the upload is complete
+        with self._cond:
+            ready = self._cond.wait_for(lambda: self.aborted or self.complete or self.received >= n_bytes,
+                                        timeout=self.timeout)
+            if self.aborted:
+                raise UploadAborted(f"Upload of {self.path} was aborted")
+            if not ready:
+                raise TimeoutError(f"No data for {self.path} in {self.timeout} s")
+            return self.received
+
+    def reader(self):
+        return _UploadReader(self)
+
+
+class _UploadReader(io.RawIOBase):
+    # Seekable reader of a ChunkedUpload, what soundfile needs to decode the file while it arrives.
+    # Reads past the received part block until the data is there, the end of the file is the
+    # announced size
+    def __init__(self, upload):
+        self.upload = upload
+        self.name = upload.path
+        self._file = open(upload.path, 'rb')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.upload.size + offset
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self.upload.size)
+        if end <= self._pos:
+            return 0
+        self.upload.wait_for(end)
+        self._file.seek(self._pos)
+        n = self._file.readinto(memoryview(buffer)[:end - self._pos])
+        self._pos += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
@@ -0,0 +1,113 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class InferenceStopped(Exception):
+    pass
+
+
+class InferenceService:
+    # Shared by every session: segments are submitted to one queue and worker threads take them off
+    # in micro-batches, so segments of different uploads go through the model in the same forward pass.
+    # A worker waits at most max_wait seconds after the first segment for the batch to fill up.
+    # predict(spectrograms) returns one prediction per spectrogram, every submit gets a Future that
+    # resolves to its own prediction, which keeps the results with the session that asked for them.
+    # The service doesn't set the number of torch threads, the app does that once at startup
+    def __init__(self, predict, max_batch=16, max_wait=0.02, n_workers=2, timeout=60):
+        self.predict_fn = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.batches = 0
+        self.segments = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.threads:
+                return self
+            self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self.n_workers)]
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def stop(self):
+        # Segments still in the queue fail with InferenceStopped, so nobody waits for them forever
+        with self._lock:
+            self.stopped.set()
+            while True:
+                try:
+                    _, future = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(InferenceStopped("The inference service was stopped"))
+
+    def submit(self, spectrogram):
+        if not self.threads:
+            self.start()
+        future = Future()
+        with self._lock:
+            if self.stopped.is_set():
+                raise InferenceStopped("The inference service was stopped")
+            self.queue.put((spectrogram, future))
+        return future
+
+    def predict(self, spectrograms, timeout=None):
+        # Submits the spectrograms and waits for their predictions, returned in the same order.
+        # Raises TimeoutError if they aren't all there within timeout seconds (self.timeout by default),
+        # the segments that haven't gone through the model yet are then cancelled
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        futures = [self.submit(spectrogram) for spectrogram in spectrograms]
+        try:
+            return [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise TimeoutError(f"No predictions for {len(futures)} segments in {timeout} s")
+
+    def stats(self):
+        return {'batches': self.batches, 'segments': self.segments, 'queued': self.queue.qsize(),
+                'mean_batch_size': self.segments / self.batches if self.batches else None}
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                # Whatever is already queued is taken even after the deadline
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # Segments of a session that stopped waiting for them are dropped
+        return [(spectrogram, future) for spectrogram, future in batch if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while not self.stopped.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                predictions = self.predict_fn([spectrogram for spectrogram, _ in batch])
+            except Exception as e:
+                print(f"Inference failed for a batch of {len(batch)} segments. Reason: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                self.batches += 1
+                self.segments += len(batch)
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
@@ -0,0 +1,131 @@
+import os
+import time
+import pstats
+import cProfile
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Stages of an upload in the order they happen, the stats list them in this order
+STAGES = ['save', 'decode', 'write_segments', 'cache', 'spectrogram', 'write_png', 'predict', 'emit']
+
+
+class RequestTimer:
+    # Wall and CPU time per stage of one upload. Stages of the pipelined path run in different
+    # threads at the same time, so the CPU time is that of the thread running the stage
+    # (time.thread_time), not of the process. Threads that torch starts for a forward pass are not
+    # counted, so the CPU time of 'predict' can be lower than its wall time
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.start = time.perf_counter()
+        self.wall = defaultdict(float)
+        self.cpu = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.segments = 0
+        self.first_result = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            with self._lock:
+                self.wall[name] += wall
+                self.cpu[name] += cpu
+                self.calls[name] += 1
+
+    def timed_iter(self, name, iterable):
+        # Times producing each item of iterable, e.g. decoding the next segment of a stream
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def result_sent(self, n=1):
+        with self._lock:
+            if self.first_result is None:
+                self.first_result = time.perf_counter() - self.start
+            self.segments += n
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        return {
+            'session_id': self.session_id,
+            'total': total,
+            'first_result': self.first_result,
+            'segments': self.segments,
+            'wall': dict(self.wall),
+            'cpu': dict(self.cpu),
+            'calls': dict(self.calls),
+        }
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+class LatencyStats:
+    # Rolling window of the last `window` finished uploads, summarized by /stats
+    def __init__(self, window=200):
+        self.requests = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, timer):
+        record = timer.finish()
+        with self._lock:
+            self.requests.append(record)
+
+        breakdown = ', '.join(f"{name} {record['wall'][name]:.2f}s/{record['cpu'][name]:.2f}s cpu"
+                              for name in STAGES if name in record['wall'])
+        print(f"Upload of {record['segments']} segments took {record['total']:.2f}s ({breakdown})")
+        return record
+
+    def summary(self):
+        with self._lock:
+            requests = list(self.requests)
+
+        total_seconds = sum(r['total'] for r in requests)
+        total_segments = sum(r['segments'] for r in requests)
+        stages = {}
+        for name in STAGES + sorted({name for r in requests for name in r['wall']} - set(STAGES)):
+            timed = [r for r in requests if name in r['wall']]
+            if timed:
+                stages[name] = {'wall': _percentiles([r['wall'][name] for r in timed]),
+                                'cpu': _percentiles([r['cpu'][name] for r in timed])}
+        return {
+            'requests': len(requests),
+            'segments': total_segments,
+            'segments_per_s': total_segments / total_seconds if total_seconds > 0 else None,
+            'latency': _percentiles([r['total'] for r in requests]),
+            'first_result': _percentiles([r['first_result'] for r in requests if r['first_result'] is not None]),
+            'stages': stages,
+        }
+
+
+@contextmanager
+def profiled(output_dir, name):
+    # Runs the block under cProfile and writes the stats to <output_dir>/<name>.prof, which
+    # `python -m pstats` or snakeviz can open. Only the calling thread is profiled
+    os.makedirs(output_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(output_dir, f"{name}.prof")
+        profiler.dump_stats(path)
+        print(f"Saved profile to {path}")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
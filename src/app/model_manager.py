@@ -0,0 +1,142 @@
+import os
+import sys
+import hashlib
+import threading
+
+import numpy as np
+import torch
+from fastai.learner import load_learner
+from huggingface_hub import hf_hub_download
+
+from src.models.predict_model import ScriptedModel
+
+# Huggingface
+REPO = "gruppe11/audio-classifier"
+FILENAME = "instrument_classifier7.pkl"
+
+
+# The exported learner refers to these by name, they are never called at inference
+def get_x(r):
+    return r
+
+def get_y(r):
+    return None
+
+
+class ModelManager:
+    # Loads the learner on first use, or in the background with load_in_background(), and warms it up
+    # with a forward pass before reporting ready. The model is read from model_path if given,
+    # otherwise from the Huggingface cache, which is only downloaded to when local_files_only is off.
+    # A .pt model_path is a TorchScript export of train_model.py, served without the fastai learner
+    def __init__(self, repo=REPO, filename=FILENAME, model_path=None, local_files_only=False):
+        self.repo = repo
+        self.filename = filename
+        self.model_path = model_path
+        self.local_files_only = local_files_only
+        self.state = 'not_loaded'
+        self.error = None
+        # Digest of the model file, so cached predictions of another model are never used
+        self.version = None
+        self._learn = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def status(self):
+        return {'state': self.state, 'model': self.model_path or f"{self.repo}/{self.filename}",
+                'backend': 'torchscript' if self.scripted else 'fastai', 'version': self.version,
+                'error': str(self.error) if self.error else None}
+
+    @property
+    def scripted(self):
+        return str(self.model_path or '').endswith('.pt')
+
+    def load_in_background(self):
+        thread = threading.Thread(target=self._load, daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, timeout=None):
+        # Returns the learner, loading it first if nobody has started to
+        if self.state == 'not_loaded':
+            self._load()
+        if not self._loaded.wait(timeout):
+            raise TimeoutError("Model is still loading")
+        if self._learn is None:
+            raise RuntimeError(f"Model failed to load: {self.error}")
+        return self._learn
+
+    def _load(self):
+        with self._lock:
+            if self.state != 'not_loaded':
+                return
+            self.state = 'loading'
+
+        try:
+            model_path = self.model_path or self._cached_model_path()
+
+            # Pickles exported from a script refer to get_x/get_y in __main__, which is not
+            # this app when it is imported by a test or started with `flask run`
+            main = sys.modules['__main__']
+            for name, fn in (('get_x', get_x), ('get_y', get_y)):
+                if not hasattr(main, name):
+                    setattr(main, name, fn)
+
+            if self.scripted:
+                learn = ScriptedModel(model_path)
+                if learn.config['input'] != 'rgb':
+                    raise ValueError(f"The app renders RGB spectrograms, {model_path} takes {learn.config['input']}")
+            else:
+                learn = load_learner(model_path)
+            warm_up(learn)
+
+            self.version = file_digest(model_path)
+            self._learn = learn
+            self.state = 'ready'
+            print("Model loaded: " + str(model_path))
+        except Exception as e:
+            self.error = e
+            self.state = 'failed'
+            print(f"Failed to load model. Reason: {e}")
+        finally:
+            self._loaded.set()
+
+    def _cached_model_path(self):
+        # Use the local Huggingface cache without touching the network when the model is in it
+        try:
+            return hf_hub_download(self.repo, self.filename, local_files_only=True)
+        except Exception:
+            if self.local_files_only:
+                raise
+        return hf_hub_download(self.repo, self.filename)
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def warm_up(learn, n_frames=259):
+    # One forward pass on a blank spectrogram, so the first real request doesn't pay for
+    # lazy initialisation in torch and the fastai transforms
+    dummy = np.zeros((128, n_frames, 3), dtype=np.uint8)
+    if isinstance(learn, ScriptedModel):
+        learn.predict_batch([dummy])
+        return
+    dl = learn.dls.test_dl([dummy], bs=1, num_workers=0)
+    learn.model.eval()
+    with torch.inference_mode():
+        for xb, in dl:
+            learn.model(xb)
+
+
+def model_manager_from_env():
+    # MODEL_PATH points at a local .pkl, MODEL_LOCAL_ONLY=1 forbids downloading from Huggingface
+    return ModelManager(model_path=os.environ.get('MODEL_PATH'),
+                        local_files_only=os.environ.get('MODEL_LOCAL_ONLY', '0') == '1')
@@ -0,0 +1,165 @@
+import queue
+import threading
+
+import numpy as np
+import soundfile as sf
+import soxr
+import librosa
+
+# Marks the end of the stream in the queues between stages
+_DONE = object()
+
+
+def stream_segments(file_path, sr=44100, segment_length=3):
+    # Yields (index, segment) pairs while the file is still being decoded, so the first segment
+    # is ready after reading a few seconds of audio instead of the whole song. file_path can also be
+    # a file object, e.g. the reader of an upload that is still arriving
+    segment_samples = int(sr * segment_length)
+    try:
+        f = sf.SoundFile(file_path)
+    except Exception:
+        # Formats libsndfile can't read (m4a, ...) are decoded in one go instead. A file object is
+        # read to the end first, so the whole file is on disk at its name
+        if hasattr(file_path, 'read'):
+            while file_path.read(2**20):
+                pass
+            file_path = file_path.name
+        y, _ = librosa.load(file_path, sr=sr, mono=True)
+        for i, start in enumerate(range(0, len(y), segment_samples)):
+            yield i, y[start:start + segment_samples]
+        return
+
+    with f:
+        resampler = soxr.ResampleStream(f.samplerate, sr, 1, dtype='float32') if f.samplerate != sr else None
+        buffer = np.zeros(0, dtype=np.float32)
+        index = 0
+
+        blocks = f.blocks(blocksize=int(f.samplerate * segment_length), dtype='float32', always_2d=True)
+        for block in blocks:
+            y = block.mean(axis=1)
+            if resampler is not None:
+                y = resampler.resample_chunk(y)
+            buffer = np.concatenate((buffer, y))
+
+            while len(buffer) >= segment_samples:
+                yield index, buffer[:segment_samples]
+                buffer = buffer[segment_samples:]
+                index += 1
+
+        # Flush what is left in the resampler, the last segment may be shorter
+        if resampler is not None:
+            buffer = np.concatenate((buffer, resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)))
+        if len(buffer):
+            yield index, buffer
+
+
+class SegmentPipeline:
+    # Runs decoding, feature extraction and inference as three threads connected by bounded queues.
+    # segments yields (index, audio), featurize(index, audio) returns a feature, predict(features)
+    # returns one result per feature and on_result(index, feature, result) is called in segment order.
+    # on_done() is called once every result is out, unless the pipeline was stopped or failed
+    def __init__(self, segments, featurize, predict, on_result, batch_size=16, queue_size=32, on_error=None,
+                 on_done=None):
+        self.segments = segments
+        self.featurize = featurize
+        self.predict = predict
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_done = on_done
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.audio_queue = queue.Queue(maxsize=queue_size)
+        self.feature_queue = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._run_stage, args=(self._decode,), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._extract,), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._infer,), daemon=True),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            # A stage that fails because the pipeline was stopped, e.g. its input went away, is not an error
+            if self.stopped.is_set():
+                return
+            print(f"Pipeline stage {stage.__name__} failed. Reason: {e}")
+            # Stopping makes the other stages return instead of waiting on the queues
+            self.stop()
+            if self.on_error is not None:
+                self.on_error(e)
+
+    def _put(self, q, item):
+        # Blocks while the queue is full, but gives up once the pipeline is stopped
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _decode(self):
+        for index, audio in self.segments:
+            if not self._put(self.audio_queue, (index, audio)):
+                return
+        self._put(self.audio_queue, _DONE)
+
+    def _extract(self):
+        while True:
+            item = self._get(self.audio_queue)
+            if item is _DONE:
+                break
+            index, audio = item
+            if not self._put(self.feature_queue, (index, self.featurize(index, audio))):
+                return
+        self._put(self.feature_queue, _DONE)
+
+    def _infer(self):
+        done = False
+        while not done:
+            item = self._get(self.feature_queue)
+            if item is _DONE:
+                break
+            batch = [item]
+
+            # Take whatever else is ready, up to a full batch, without waiting for more
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.feature_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            results = self.predict([feature for _, feature in batch])
+            for (index, feature), result in zip(batch, results):
+                if self.stopped.is_set():
+                    return
+                self.on_result(index, feature, result)
+
+        # _get also returns _DONE when the pipeline is stopped
+        if not self.stopped.is_set() and self.on_done is not None:
+            self.on_done()
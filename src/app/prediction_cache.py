@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def segment_key(y, sr, model_version):
+    # Identifies the prediction of a segment: its decoded samples, the rate they were decoded at and
+    # the model that made it
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{model_version}:{sr}:".encode())
+    h.update(np.ascontiguousarray(y, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def _copy_or_link(src, dst):
+    # A hard link when both are on the same file system, a copy otherwise. Cached files are only
+    # ever replaced, never written in place, so sessions can share them. A file already at dst may be
+    # a link to another entry, so it is removed rather than written over
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class PredictionCache:
+    # Predictions and spectrogram images of segments on disk as <key>.json and <key>.png, least
+    # recently used entries are deleted once the files take up more than max_bytes. The order of use
+    # is kept in memory and restored from the modification times when the app restarts. Nothing is
+    # read or created in cache_dir before the first lookup
+    def __init__(self, cache_dir, max_bytes=512 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.png')
+
+    def _load(self):
+        # Called with the lock held
+        if self._loaded:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            json_path, png_path = self._paths(key)
+            if not os.path.exists(png_path):
+                os.unlink(json_path)
+                continue
+            stat = os.stat(json_path)
+            entries.append((stat.st_mtime, key, stat.st_size + os.path.getsize(png_path)))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        self._loaded = True
+        self._evict()
+
+    def get(self, key, png_path=None):
+        # Returns the cached prediction or None. On a hit the image is also put at png_path
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+        json_path, cached_png_path = self._paths(key)
+        try:
+            with open(json_path) as f:
+                prediction = json.load(f)
+            if png_path is not None:
+                _copy_or_link(cached_png_path, png_path)
+            # The modification time is the order of use after a restart
+            os.utime(json_path)
+        except OSError:
+            # Evicted by another thread in the meantime
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return prediction
+
+    def put(self, key, prediction, png_path):
+        with self._lock:
+            self._load()
+        json_path, cached_png_path = self._paths(key)
+        # Written under temporary names first, so a reader never sees half a file, and the json
+        # goes last since an entry only counts once it is there
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(json_path + suffix, 'w') as f:
+            json.dump(prediction, f)
+        # A copy, the session's image may be deleted or written again
+        shutil.copyfile(png_path, cached_png_path + suffix)
+        os.replace(cached_png_path + suffix, cached_png_path)
+        os.replace(json_path + suffix, json_path)
+
+        size = os.path.getsize(json_path) + os.path.getsize(cached_png_path)
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            for path in self._paths(key):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self._size,
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from src.features.mix_audio_clips import determine_frequency_range, mix_clips_from_different_ranges
+from src.features.sampling_index import SamplingIndex
+from src.features.augment import AugmentationEngine, WILDCARD_EFFECTS, NOISE_TYPES, _preemphasis
+from src.features.noise_bank import NoiseBank
+from src.features.generate_spectrograms import generate_spectrograms
+
+SR = 44100
+
+# Synthetic instruments: a base frequency and how many harmonics it has, so the sources land in
+# different frequency ranges like real recordings do
+SYNTHETIC_INSTRUMENTS = {
+    'Double_bass': (55, 4), 'Bass_drum': (60, 1), 'Cello': (130, 8), 'Piano': (260, 10),
+    'Acoustic_guitar': (330, 12), 'Vocal': (440, 6), 'Trumpet': (520, 10), 'Flute': (880, 4),
+    'Violin': (660, 14), 'Hi-hat': (7000, 1),
+}
+
+GENRES = ['classical', 'rock', 'jazz', 'blues', 'folk', 'electronic', 'world', 'wildcard', 'pop']
+
+
+def synthetic_clip(label, duration, rng):
+    # Harmonic tone with a decaying envelope plus a little noise
+    base, n_harmonics = SYNTHETIC_INSTRUMENTS[label]
+    t = np.arange(int(duration * SR)) / SR
+    y = sum(np.sin(2 * np.pi * base * k * t + rng.uniform(0, 2 * np.pi)) / k for k in range(1, n_harmonics + 1))
+    y = y * np.exp(-t * rng.uniform(0.2, 2)) + 0.01 * rng.randn(len(t))
+    return (0.5 * y / np.max(np.abs(y))).astype(np.float32)
+
+
+def make_sources(directory, n_sources, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = list(SYNTHETIC_INSTRUMENTS)
+    rows = []
+    for i in range(n_sources):
+        label = labels[i % len(labels)]
+        path = os.path.join(directory, f'source_{i}.wav')
+        sf.write(path, synthetic_clip(label, rng.uniform(1, 6), rng), SR)
+        rows.append({'fname': os.path.basename(path), 'path': path, 'label': label, 'dataset': 'synthetic'})
+    return pd.DataFrame(rows)
+
+
+def _peak_rss_mb():
+    # Peak resident set size since the last _reset_peak_rss, from /proc when available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, and can't be reset
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def adjust_for_genre(augmenter, batch, genre, effects):
+    # Only the genre branch of AugmentationEngine._apply_batch, with no speed change, so the time of a
+    # genre isn't mixed up with the random stretching, slicing and noise
+    clips = augmenter._spectral(augmenter._adjust_for_genre(batch, genre, effects), genre,
+                                np.zeros(len(batch), dtype=bool), np.ones(len(batch)))
+    if genre == 'pop':
+        clips = [_preemphasis(clip, coef=0.97) for clip in clips]
+    return clips
+
+
+def run_stage(name, fn, items, n_clips_per_item=1, repeat=1, warm_up=True):
+    # Calls fn(item) for every item, repeat times, and reports the latency of each call together
+    # with the throughput in clips/s and the peak RSS while the stage ran. One untimed call first
+    # keeps one-off costs (imports, numba compilation, caches) out of the numbers
+    items = list(items)
+    if warm_up and items:
+        fn(items[0])
+    _reset_peak_rss()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            call_start = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - call_start)
+    seconds = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    result = {
+        'calls': len(latencies),
+        'clips': len(latencies) * n_clips_per_item,
+        'seconds': seconds,
+        'clips_per_s': len(latencies) * n_clips_per_item / seconds if seconds > 0 else None,
+        'latency_ms': {
+            'mean': float(latencies_ms.mean()),
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p90': float(np.percentile(latencies_ms, 90)),
+            'p99': float(np.percentile(latencies_ms, 99)),
+            'max': float(latencies_ms.max()),
+        },
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+    print(f"{name:<40}{result['clips_per_s']:10.1f} clips/s  p50 {result['latency_ms']['p50']:8.1f} ms  "
+          f"p99 {result['latency_ms']['p99']:8.1f} ms  peak RSS {result['peak_rss_mb']:7.0f} MB")
+    return result
+
+
+def benchmark_app(work_dir, n_uploads, song_seconds):
+    # Uploads a synthetic song through the Socket.IO handler with the non-pipelined path, which
+    # runs generate_and_predict_spectrograms inside the handler. Needs a model (MODEL_PATH or the
+    # Huggingface cache), the stage is skipped when it can't be loaded
+    from src.app import app as app_module
+    try:
+        app_module.model_manager.get()
+    except Exception as e:
+        print(f"Skipping app benchmark, no model. Reason: {e}")
+        return {'skipped': str(e)}
+
+    rng = np.random.RandomState(1)
+    labels = list(SYNTHETIC_INSTRUMENTS)
+    song = sum(synthetic_clip(labels[k], song_seconds, rng) for k in rng.choice(len(labels), 4, replace=False))
+    song_path = os.path.join(work_dir, 'song.wav')
+    sf.write(song_path, song / np.max(np.abs(song)), SR)
+    with open(song_path, 'rb') as f:
+        song_data = f.read()
+
+    app_module.app.config['PIPELINED'] = False
+    client = app_module.socketio.test_client(app_module.app)
+    n_segments = int(np.ceil(song_seconds / app_module.SEGMENT_LENGTH))
+
+    def upload(_):
+        client.emit('song_uploaded', {'filename': 'song.wav', 'song_data': song_data})
+        client.get_received()
+
+    try:
+        return run_stage('app generate_and_predict_spectrograms', upload, range(n_uploads),
+                         n_clips_per_item=n_segments)
+    finally:
+        client.disconnect()
+
+
+def run_benchmarks(n_sources=60, n_mixes=20, n_effects=20, n_uploads=3, song_seconds=30, seed=0, app=True):
+    work_dir = tempfile.mkdtemp(prefix='audio_benchmark_')
+    results = {}
+    try:
+        source_dir = os.path.join(work_dir, 'sources')
+        os.makedirs(source_dir)
+        df = make_sources(source_dir, n_sources, seed)
+
+        results['determine_frequency_range'] = run_stage(
+            'determine_frequency_range', determine_frequency_range, df['path'].tolist())
+        df['frequency_range'] = [determine_frequency_range(path) for path in df['path']]
+
+        genre_instruments = {genre: list(SYNTHETIC_INSTRUMENTS) for genre in GENRES}
+        sampling_index = SamplingIndex.from_frame(df, genre_instruments)
+        augmenter = AugmentationEngine(NoiseBank(os.path.join(work_dir, 'noise_bank')))
+        augmenter.noise_bank.register('hum', synthetic_clip('Double_bass', 10, np.random.RandomState(seed)))
+
+        mix_dir = os.path.join(work_dir, 'mixes')
+        os.makedirs(mix_dir)
+        mix_paths = []
+
+        def mix(i):
+            _, _, path = mix_clips_from_different_ranges(sampling_index, os.path.join(mix_dir, f'mixed_clip_{i}'),
+                                                         augmenter=augmenter, rng=random.Random(seed + i),
+                                                         np_rng=np.random.RandomState(seed + i))
+            mix_paths.append(path)
+
+        results['mix_clips_from_different_ranges'] = run_stage('mix_clips_from_different_ranges', mix, range(n_mixes))
+        results['augmentation_timings_s'] = augmenter.pop_timings()
+
+        # Effects on 3 second clips, applied to 5 sources at a time like the mixer does. The time
+        # per transform (genre adjustment, speed, slicing, noise) is in effects_timings_s
+        rng = np.random.RandomState(seed)
+        labels = list(SYNTHETIC_INSTRUMENTS)
+        clips = [synthetic_clip(labels[i % len(labels)], 3, rng) for i in range(n_effects)]
+
+        for genre in GENRES:
+            results[f'AugmentationEngine.apply[{genre}]'] = run_stage(
+                f'AugmentationEngine.apply[{genre}]', lambda batch: augmenter.apply(batch, genre, rng=rng),
+                [clips[i:i + 5] for i in range(0, len(clips), 5)], n_clips_per_item=5)
+        results['effects_timings_s'] = augmenter.pop_timings()
+
+        # Each genre adjustment and noise type on its own, on the same stacks of 5 clips. The wildcard
+        # effects and the noise windows come from fixed seeds, so every run times the same work
+        batches = [np.stack(clips[i:i + 5]).astype(np.float32) for i in range(0, len(clips), 5)]
+        effects = np.random.RandomState(seed).randint(len(WILDCARD_EFFECTS), size=5)
+        for genre in GENRES:
+            results[f'adjust_for_genre[{genre}]'] = run_stage(
+                f'adjust_for_genre[{genre}]', lambda batch: adjust_for_genre(augmenter, batch, genre, effects),
+                batches, n_clips_per_item=5)
+        for noise_type in NOISE_TYPES:
+            noise_rng = np.random.RandomState(seed)
+            results[f'add_noise[{noise_type}]'] = run_stage(
+                f'add_noise[{noise_type}]',
+                lambda batch: [augmenter._add_noise(clip, noise_type, 20, noise_rng) for clip in batch],
+                batches, n_clips_per_item=5)
+        # These stages are timed above, drop what they added to the engine's own timings
+        augmenter.pop_timings()
+
+        mixes = pd.DataFrame({'path': mix_paths})
+        for output_format in ('png', 'array'):
+            spec_dir = os.path.join(work_dir, f'spectrograms_{output_format}')
+            results[f'generate_spectrograms[{output_format}]'] = run_stage(
+                f'generate_spectrograms[{output_format}]',
+                lambda _: generate_spectrograms(mixes.copy(), spec_dir, output_format=output_format),
+                range(1), n_clips_per_item=len(mixes))
+
+        if app:
+            results['app generate_and_predict_spectrograms'] = benchmark_app(work_dir, n_uploads, song_seconds)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def save_results(results, output_dir, config):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    commit = _git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'stages': results,
+    }
+    path = output_dir / f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit or 'nocommit'}.json"
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark results to {path}")
+    return path
+
+
+if __name__ == '__main__':
+    PROJECT_ROOT = Path(__file__).resolve().parents[2]
+
+    parser = argparse.ArgumentParser(description="Benchmark the dataset build pipeline and the app on synthetic audio")
+    parser.add_argument('--sources', type=int, default=60, help="number of synthetic source clips")
+    parser.add_argument('--mixes', type=int, default=20, help="number of mixed clips")
+    parser.add_argument('--effects', type=int, default=20, help="clips per effect benchmark")
+    parser.add_argument('--uploads', type=int, default=3, help="song uploads in the app benchmark")
+    parser.add_argument('--no-app', action='store_true', help="skip the app benchmark")
+    parser.add_argument('--output', default=PROJECT_ROOT / 'reports' / 'benchmarks', help="directory for the JSON results")
+    args = parser.parse_args()
+
+    config = {'sources': args.sources, 'mixes': args.mixes, 'effects': args.effects, 'uploads': args.uploads}
+    results = run_benchmarks(args.sources, args.mixes, args.effects, args.uploads, app=not args.no_app)
+    save_results(results, args.output, config)
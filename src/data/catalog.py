@@ -0,0 +1,148 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import soundfile as sf
+
+# A catalog is a directory holding the base table in base.parquet, plus one parquet file per column
+# added later in columns/. Adding or replacing a column only writes that column's file
+BASE_FILE = 'base.parquet'
+COLUMNS_DIR = 'columns'
+
+# Columns with few distinct values are stored dictionary encoded and load as pandas categoricals
+CATEGORICAL_COLUMNS = ['label', 'dataset', 'frequency_range', 'genre']
+
+
+def _prepare(df):
+    df = df.reset_index(drop=True)
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS:
+            df[column] = df[column].astype('category')
+        elif column.endswith('path'):
+            # Paths are stored as plain strings, some datasets build them as Path objects
+            df[column] = df[column].map(lambda p: str(p) if p is not None and p == p else None)
+    return df
+
+
+def catalog_exists(catalog_dir):
+    return (Path(catalog_dir) / BASE_FILE).exists()
+
+
+def save_catalog(df, catalog_dir):
+    # Writes df as a new catalog, replacing whatever was in catalog_dir
+    catalog_dir = Path(catalog_dir)
+    (catalog_dir / COLUMNS_DIR).mkdir(parents=True, exist_ok=True)
+    for column_file in (catalog_dir / COLUMNS_DIR).glob('*.parquet'):
+        os.remove(column_file)
+
+    _write(_prepare(df), catalog_dir / BASE_FILE)
+
+
+def add_columns(catalog_dir, columns):
+    # Adds (or replaces) the columns of the columns DataFrame, which has one row per catalog row
+    catalog_dir = Path(catalog_dir)
+    n_rows = pq.ParquetFile(catalog_dir / BASE_FILE).metadata.num_rows
+    if len(columns) != n_rows:
+        raise ValueError(f"Catalog has {n_rows} rows, got {len(columns)} values per column")
+
+    columns = _prepare(pd.DataFrame(columns))
+    for column in columns.columns:
+        _write(columns[[column]], catalog_dir / COLUMNS_DIR / f'{column}.parquet')
+
+
+def _write(df, path):
+    # Write next to the target and rename, so a crash never leaves half a file behind
+    tmp_path = path.with_name(path.name + '.tmp')
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def catalog_columns(catalog_dir):
+    catalog_dir = Path(catalog_dir)
+    columns = pq.read_schema(catalog_dir / BASE_FILE).names
+    added = [p.stem for p in sorted((catalog_dir / COLUMNS_DIR).glob('*.parquet'))]
+    return [c for c in columns if c not in added] + added
+
+
+def load_catalog(catalog_dir, columns=None, labels=None, datasets=None):
+    # Loads the catalog as a DataFrame, optionally only some columns and only the rows whose
+    # label is in labels and whose dataset is in datasets
+    catalog_dir = Path(catalog_dir)
+    base_columns = pq.read_schema(catalog_dir / BASE_FILE).names
+    column_files = {p.stem: p for p in (catalog_dir / COLUMNS_DIR).glob('*.parquet')}
+    wanted = columns if columns is not None else catalog_columns(catalog_dir)
+
+    # Rows are selected on the (dictionary encoded) label and dataset columns first, the same
+    # row mask is then applied to every other column
+    mask = None
+    for column, values in (('label', labels), ('dataset', datasets)):
+        if values is None:
+            continue
+        table = _read_column(catalog_dir, column, column_files)
+        column_mask = pc.is_in(table.column(column), value_set=pa.array(list(values)))
+        mask = column_mask if mask is None else pc.and_(mask, column_mask)
+
+    tables = []
+    from_base = [c for c in wanted if c in base_columns and c not in column_files]
+    if from_base:
+        tables.append(pq.read_table(catalog_dir / BASE_FILE, columns=from_base))
+    for column in wanted:
+        if column in column_files:
+            tables.append(pq.read_table(column_files[column]))
+        elif column not in base_columns:
+            raise KeyError(f"Catalog at {catalog_dir} has no column {column}")
+
+    frames = [(t.filter(mask) if mask is not None else t).to_pandas() for t in tables]
+    df = pd.concat(frames, axis=1) if frames else pd.DataFrame()
+    return df[wanted]
+
+
+def _read_column(catalog_dir, column, column_files):
+    if column in column_files:
+        return pq.read_table(column_files[column])
+    return pq.read_table(catalog_dir / BASE_FILE, columns=[column])
+
+
+def _audio_info(path):
+    try:
+        info = sf.info(path)
+        return info.frames / info.samplerate, info.samplerate
+    except Exception:
+        return np.nan, np.nan
+
+
+def add_audio_info(df, n_workers=16):
+    # Adds 'duration' (seconds) and 'sample_rate' from the file headers, without decoding the audio.
+    # Rows that already have a sample rate keep theirs
+    df = df.copy()
+    if 'sample_rate' not in df.columns:
+        df['duration'] = np.nan
+        df['sample_rate'] = pd.array([pd.NA] * len(df), dtype='Int32')
+    missing = df['sample_rate'].isna().to_numpy()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        info = list(executor.map(_audio_info, df.loc[missing, 'path'].astype(str)))
+    if info:
+        df.loc[missing, 'duration'] = [duration for duration, _ in info]
+        df.loc[missing, 'sample_rate'] = pd.array([sample_rate for _, sample_rate in info], dtype='Int32')
+    return df
+
+
+def refresh_catalog(df, catalog_dir):
+    # Replaces the rows of the catalog with those of df. For paths that were already in the catalog,
+    # the columns df doesn't have (durations, band energies, ...) are carried over, so only new
+    # files are read
+    df = _prepare(df)
+    if catalog_exists(catalog_dir):
+        previous = load_catalog(catalog_dir)
+        extra = [c for c in previous.columns if c not in df.columns]
+        df = df.merge(previous[['path'] + extra].drop_duplicates('path'), on='path', how='left')
+
+    df = add_audio_info(df)
+    save_catalog(df, catalog_dir)
+    return df
@@ -7,6 +7,7 @@ from src.data.download_vocalset import download_vocalset
 from src.data.download_misd import download_misd
 from src.data.download_irmas import download_irmas
 from src.data.download_philharmonia import download_philharmonia
+from src.data.catalog import refresh_catalog
 import concurrent.futures
 
 def download_all(directory):
@@ -26,8 +27,9 @@ def download_all(directory):
     # Combine the metadata
     metadata = pd.concat([fsdkaggle_meta, vocalset_meta, misd_meta, irmas_meta, philharmonia_meta], ignore_index=True)
 
-    # Save metadata
-    metadata.to_csv(directory / 'metadata.csv', index=False)
+    # Save metadata. Duration and sample rate are read from the file headers once, so nothing
+    # downstream has to, and only for files that are new since the last run
+    metadata = refresh_catalog(metadata, directory / 'catalog')
     
     return metadata
 
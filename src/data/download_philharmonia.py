@@ -1,87 +1,95 @@
 import os
 from pathlib import Path
 import shutil
-import zipfile
 
-import pandas as pd
-import requests
 from tqdm import tqdm
 
-from pydub import AudioSegment
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from pydub.exceptions import CouldntDecodeError
+import librosa
+import soundfile as sf
 
-def download_and_unzip(url, dir_name):
-    if not os.path.isdir(dir_name):
-        # Download the file
-        response = requests.get(url, stream=True)
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 1024
-        progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True, desc="Downloading Philharmonia dataset")
-        zip_file_name = f"{dir_name}.zip"
-        with open(zip_file_name, 'wb') as f:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                f.write(data)
-        progress_bar.close()
-        if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-            print("ERROR, something went wrong")
+from src.data.download_utils import download_and_unzip, extract_zip
+from src.data.scan import scan_directory, MANIFEST_FILE
 
-        # Unzip the file
-        with zipfile.ZipFile(zip_file_name, 'r') as zip_ref:
-            zip_ref.extractall(dir_name)
+def extract_instrument_zips(dir_name):
+    # Navigate to the "all-samples" directory and extract sub-zip files. Zips are removed once
+    # extracted, so an interrupted run continues with the ones that are left
+    all_samples_dir = Path(dir_name) / "all-samples"
+    if not all_samples_dir.is_dir():
+        return
+    for instrument_zip in list(all_samples_dir.iterdir()):
+        if instrument_zip.is_file() and instrument_zip.suffix == '.zip':
+            # Create a directory for the instrument
+            instrument_dir = all_samples_dir / instrument_zip.stem
+            instrument_dir.mkdir(exist_ok=True)
+            # Unzip the instrument file into its directory
+            extract_zip(instrument_zip, instrument_dir)
 
-        # Navigate to the "all-samples" directory and extract sub-zip files
-        all_samples_dir = Path(dir_name) / "all-samples"
-        for instrument_zip in all_samples_dir.iterdir():
-            if instrument_zip.is_file() and instrument_zip.suffix == '.zip':
-                # Create a directory for the instrument
-                instrument_dir = all_samples_dir / instrument_zip.stem
-                instrument_dir.mkdir(exist_ok=True)
-                # Unzip the instrument file into its directory
-                with zipfile.ZipFile(instrument_zip, 'r') as zip_ref:
-                    zip_ref.extractall(instrument_dir)
-                os.remove(instrument_zip)
+            # Now handle subdirectories within this instrument directory
+            for sub_dir in instrument_dir.iterdir():
+                if sub_dir.is_dir():  # It's a subdirectory with samples
+                    # Move all files from the subdirectory to the instrument directory
+                    for sub_file in sub_dir.iterdir():
+                        if sub_file.is_file():
+                            shutil.move(str(sub_file), str(instrument_dir / sub_file.name))
+                    # Remove the now-empty subdirectory
+                    os.rmdir(sub_dir)
+            os.remove(instrument_zip)
+    # Remove the __MACOSX directory if it exists
+    macosx_dir = Path(dir_name) / "__MACOSX"
+    if macosx_dir.exists():
+        shutil.rmtree(macosx_dir)
 
-                # Now handle subdirectories within this instrument directory
-                for sub_dir in instrument_dir.iterdir():
-                    if sub_dir.is_dir():  # It's a subdirectory with samples
-                        # Move all files from the subdirectory to the instrument directory
-                        for sub_file in sub_dir.iterdir():
-                            if sub_file.is_file():
-                                shutil.move(str(sub_file), str(instrument_dir))
-                        # Remove the now-empty subdirectory
-                        os.rmdir(sub_dir)
-        # Remove the __MACOSX directory if it exists
-        macosx_dir = Path(dir_name) / "__MACOSX"
-        if macosx_dir.exists():
-            shutil.rmtree(macosx_dir)
+def _is_valid_wav(wav_path, sr, subtype):
+    # A WAV from an earlier run is kept if it can be read and has the expected format
+    try:
+        info = sf.info(wav_path)
+    except Exception:
+        return False
+    return info.frames > 0 and info.samplerate == sr and info.subtype == subtype
 
-        # Remove the zip file
-        os.remove(zip_file_name)
-        print("Downloaded and unzipped Philharmonia dataset")
-    else:
-        print("Philharmonia dataset already downloaded")
+def _transcode(mp3_path, sr=44100, subtype='PCM_16'):
+    # Decodes the MP3 in this process (no ffmpeg subprocess) and writes a mono WAV next to it
+    wav_path = os.path.splitext(mp3_path)[0] + '.wav'
+    if _is_valid_wav(wav_path, sr, subtype):
+        return wav_path
+    # Write to a temporary name first, so a crash never leaves a truncated WAV behind
+    tmp_path = wav_path + '.tmp'
+    try:
+        y, _ = librosa.load(mp3_path, sr=sr, mono=True)
+        sf.write(tmp_path, y, sr, subtype=subtype, format='WAV')
+        os.replace(tmp_path, wav_path)
+        return wav_path
+    except Exception as e:
+        print(f"Could not transcode {mp3_path}. Reason: {e!r}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
 
-def download_philharmonia(directory):
+def _check_mp3(mp3_path, sr=44100, subtype=None):
+    # Keeps the MP3 as the source, it is decoded on the fly when it is used
+    try:
+        return mp3_path if sf.info(mp3_path).frames > 0 else None
+    except Exception as e:
+        print(f"Could not read {mp3_path}. Reason: {e!r}")
+        return None
+
+def download_philharmonia(directory, transcode=True, n_workers=None, sr=44100, subtype='PCM_16'):
+    # With transcode=True every MP3 is converted to a WAV at sr, with subtype 'PCM_16' or 'FLOAT'.
+    # With transcode=False the metadata points at the MP3s, which saves the disk space of the WAVs
     
     directory.mkdir(parents=True, exist_ok=True)
     DOWNLOAD_PATH = directory / 'Philharmonia'
     
     url = "https://philharmonia-assets.s3-eu-west-1.amazonaws.com/uploads/2020/02/12112005/all-samples.zip"
 
-    download_and_unzip(url, DOWNLOAD_PATH)
+    download_and_unzip(url, DOWNLOAD_PATH, desc="Philharmonia dataset")
+    extract_instrument_zips(DOWNLOAD_PATH)
     
     base_dir = DOWNLOAD_PATH / "all-samples"
     
-    # Check is metadata exists
-    if os.path.exists(DOWNLOAD_PATH / 'metadata.csv'):
-        print("Philharmonia metadata already exists")
-        return pd.read_csv(DOWNLOAD_PATH / 'metadata.csv')
-    
-    # Create a metadata file
-    data = []
-    
     dir_to_label = {
         "banjo": "Banjo",
         "bass-clarinet": "Clarinet",
@@ -145,46 +153,45 @@ def download_philharmonia(directory):
         "tom-toms": "Drum",
     }
     
-    # Get the list of all files in base_dir that end with '.mp3'
-    all_mp3_files = [os.path.join(dp, f) for dp, dn, filenames in os.walk(base_dir) for f in filenames if f.endswith('.mp3')]
-
-    # Initialize the progress bar
-    with tqdm(total=len(all_mp3_files), desc="Building Philharmonia metadata", unit="file") as pbar:
-        for file_path in all_mp3_files:
-            # Extract the base filename (e.g., 'saxophone_A3_1_forte_normal.mp3')
-            base_filename = os.path.basename(file_path)
-            try:
+    def index_files(mp3_files):
+        data = []
+        
+        # Transcode (or, with transcode=False, just check) the files in parallel. download_all runs
+        # this in a thread, and forking a process that has other threads running can deadlock the
+        # children, so the workers are spawned
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = executor.map(_transcode if transcode else _check_mp3, mp3_files,
+                                   [sr] * len(mp3_files), [subtype] * len(mp3_files), chunksize=32)
+            
+            for file_path, audio_path in tqdm(zip(mp3_files, results), total=len(mp3_files),
+                                              desc="Building Philharmonia metadata", unit="file"):
+                # Extract the base filename (e.g., 'saxophone_A3_1_forte_normal.mp3')
+                base_filename = os.path.basename(file_path)
+                
+                # Handle corrupted files
+                if audio_path is None:
+                    print(f"Could not process {base_filename}")
+                    data.append(None)
+                    continue
+                
                 # Extract label from filename
                 label = base_filename.split('_')[0]
                 
                 label_map = dir_to_label.get(label)
 
-                # Convert mp3 to wav
-                audio = AudioSegment.from_mp3(file_path)
-                wav_file = os.path.splitext(base_filename)[0] + '.wav'
-                audio.export(os.path.join(os.path.dirname(file_path), wav_file), format='wav')
-
                 # Add the metadata to the list
                 data.append({
-                    "fname": wav_file,
-                    "path": os.path.join(os.path.dirname(file_path), wav_file),
+                    "fname": os.path.basename(audio_path),
+                    "path": audio_path,
                     "label": label_map,
                     "instrument": label,
                     "dataset": "Philharmonia"
                 })
-
-            # Handle corrupted files
-            except CouldntDecodeError as e:
-                print(f"Could not process {base_filename}")
-
-            # Update the progress bar
-            pbar.update(1)
-    
-    # Create a DataFrame from the metadata
-    df = pd.DataFrame(data)
+        return data
     
-    # Save datafrae to CSV
-    df.to_csv(DOWNLOAD_PATH / 'metadata.csv', index=False)
+    # Only MP3s in directories that changed since the last run are transcoded and indexed again
+    df = scan_directory(base_dir, index_files, DOWNLOAD_PATH / MANIFEST_FILE, suffixes=('.mp3',),
+                        params={'transcode': transcode, 'sr': sr, 'subtype': subtype})
     
     return df # Return the metadata DataFrame
     
@@ -0,0 +1,190 @@
+import os
+import time
+import shutil
+import hashlib
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from tqdm import tqdm
+
+CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+MAX_RETRIES = 5
+TIMEOUT = 60  # seconds without data before a connection is dropped
+
+
+class DownloadError(IOError):
+    pass
+
+
+def download_file(url, dest, checksum=None, n_connections=4, chunk_size=CHUNK_SIZE, max_retries=MAX_RETRIES, desc=None):
+    # Downloads url to dest. Data goes to <dest>.part files first, so an interrupted download picks up
+    # where it stopped. Large files are fetched over n_connections parallel ranges when the server
+    # supports it. checksum is an optional "<algorithm>:<hexdigest>" string, e.g. "md5:..."
+    dest = Path(dest)
+    if dest.exists():
+        verify_checksum(dest, checksum)
+        return dest
+
+    with requests.Session() as session:
+        size, accepts_ranges = _probe(session, url)
+
+        if size and accepts_ranges and n_connections > 1 and size >= n_connections * chunk_size:
+            _download_parts(session, url, dest, size, n_connections, chunk_size, max_retries, desc)
+        else:
+            part_path = dest.with_name(dest.name + '.part')
+            with tqdm(total=size or None, initial=_size(part_path), unit='iB', unit_scale=True, desc=desc or dest.name) as pbar:
+                _download_range(session, url, part_path, 0, size - 1 if size else None, chunk_size, max_retries, pbar,
+                                resumable=accepts_ranges)
+            os.replace(part_path, dest)
+
+    try:
+        if size and _size(dest) != size:
+            raise DownloadError(f"Expected {size} bytes of {url}, got {_size(dest)}")
+        verify_checksum(dest, checksum)
+    except DownloadError:
+        # Don't resume from a corrupt file next time
+        os.remove(dest)
+        raise
+    return dest
+
+
+def _probe(session, url):
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if response.status_code >= 400:
+        # Some servers don't answer HEAD, ask for the headers of a GET instead
+        response = session.get(url, stream=True, timeout=TIMEOUT)
+        response.close()
+    response.raise_for_status()
+    size = int(response.headers.get('content-length', 0))
+    accepts_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return size, accepts_ranges
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _download_parts(session, url, dest, size, n_connections, chunk_size, max_retries, desc):
+    # Each connection fetches one byte range into its own part file, which are joined at the end
+    bounds = [size * i // n_connections for i in range(n_connections + 1)]
+    part_paths = [dest.with_name(f'{dest.name}.part{i}') for i in range(n_connections)]
+    done = sum(_size(p) for p in part_paths)
+
+    with tqdm(total=size, initial=done, unit='iB', unit_scale=True, desc=desc or dest.name) as pbar:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            futures = [executor.submit(_download_range, session, url, part_path, start, end - 1, chunk_size,
+                                       max_retries, pbar)
+                       for part_path, start, end in zip(part_paths, bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+    part_path = dest.with_name(dest.name + '.part')
+    with open(part_path, 'wb') as out:
+        for path in part_paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, chunk_size)
+    os.replace(part_path, dest)
+    for path in part_paths:
+        os.remove(path)
+
+
+def _download_range(session, url, part_path, start, end, chunk_size, max_retries, pbar, resumable=True):
+    # Fetches bytes start..end (inclusive, end=None for unknown size) into part_path, resuming
+    # from what part_path already holds and retrying with backoff when the connection drops
+    expected = end - start + 1 if end is not None else None
+
+    for attempt in range(max_retries + 1):
+        have = _size(part_path) if resumable else 0
+        if expected is not None and have >= expected:
+            return
+
+        headers = {}
+        if resumable and (start + have > 0 or end is not None):
+            headers['Range'] = f"bytes={start + have}-{'' if end is None else end}"
+
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code == 416:
+                    # Nothing left in the range, the part is already complete
+                    return
+                response.raise_for_status()
+
+                if response.status_code != 206:
+                    # The server ignored the range and sends the whole file from the start
+                    if start > 0:
+                        raise DownloadError(f"{url} does not support range requests")
+                    pbar.update(-have)
+                    have = 0
+
+                # Large buffered writes instead of many small ones
+                with open(part_path, 'ab' if have else 'wb', buffering=chunk_size) as f:
+                    for data in response.iter_content(chunk_size):
+                        f.write(data)
+                        pbar.update(len(data))
+
+            got = _size(part_path)
+            if expected is None or got == expected:
+                return
+            raise DownloadError(f"Expected {expected} bytes of {url}, got {got}")
+
+        except (requests.RequestException, DownloadError) as e:
+            if attempt == max_retries:
+                raise DownloadError(f"Giving up on {url} after {max_retries + 1} attempts. Reason: {e}") from e
+            wait = 2 ** attempt
+            print(f"Download of {url} interrupted ({e}), retrying in {wait}s")
+            time.sleep(wait)
+
+
+def verify_checksum(path, checksum, chunk_size=CHUNK_SIZE):
+    if not checksum:
+        return
+    algorithm, expected = checksum.split(':', 1)
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    if h.hexdigest() != expected.lower():
+        raise DownloadError(f"Checksum mismatch for {path}: expected {expected}, got {h.hexdigest()}")
+
+
+def extract_zip(zip_path, dest, chunk_size=CHUNK_SIZE):
+    # Streams every member to disk with large buffers. Members that were already extracted with
+    # the right size by an interrupted earlier run are skipped
+    dest = Path(dest)
+    with zipfile.ZipFile(zip_path) as zf:
+        members = [m for m in zf.infolist() if not m.filename.startswith('__MACOSX/')]
+        for member in tqdm(members, desc=f"Extracting {Path(zip_path).name}", unit='file'):
+            target = dest / member.filename
+            # Refuse paths that would end up outside dest
+            if not target.resolve().is_relative_to(dest.resolve()):
+                continue
+            if member.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            if target.exists() and target.stat().st_size == member.file_size:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(member) as src, open(target, 'wb') as out:
+                shutil.copyfileobj(src, out, chunk_size)
+
+
+def download_and_unzip(url, dir_name, desc=None, checksum=None):
+    # Downloads the zip next to dir_name and extracts it into dir_name. Interrupted downloads and
+    # extractions continue where they stopped on the next call
+    dir_name = Path(dir_name)
+    zip_path = Path(f"{dir_name}.zip")
+    in_progress = zip_path.exists() or any(zip_path.parent.glob(zip_path.name + '.part*'))
+
+    if dir_name.is_dir() and any(dir_name.iterdir()) and not in_progress:
+        print(f"{desc or dir_name.name} already downloaded, skipping download")
+        return False
+
+    download_file(url, zip_path, checksum=checksum, desc=f"Downloading {desc or dir_name.name}")
+    extract_zip(zip_path, dir_name)
+
+    # Remove the zip file
+    os.remove(zip_path)
+    print(f"Downloaded and unzipped {desc or dir_name.name}")
+    return True
@@ -0,0 +1,73 @@
+import os
+import json
+from pathlib import Path
+
+import pandas as pd
+
+MANIFEST_FILE = 'scan_manifest.json'
+
+
+def scan_directory(base_dir, index_files, manifest_path, suffixes=('.wav',), params=None):
+    # Builds metadata for every file under base_dir ending in one of suffixes. index_files(paths)
+    # returns one row (a dict, or None to leave the file out) per path. The manifest keeps each
+    # directory's mtime and size together with its rows, directories that haven't changed since
+    # the last scan are neither listed nor indexed again, so an unchanged tree costs one stat per
+    # directory. params are stored with the manifest, everything is re-indexed when they change
+    base_dir = Path(base_dir)
+    manifest_path = Path(manifest_path)
+    suffixes = tuple(suffixes)
+    params = dict(params or {}, suffixes=list(suffixes))
+
+    if not base_dir.is_dir():
+        return pd.DataFrame()
+
+    old = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('params') == params:
+            old = manifest['dirs']
+
+    new = {}
+    changed = {}
+    _scan(base_dir, '.', old, new, changed, suffixes)
+
+    if changed or set(old) != set(new):
+        # Index the files of all changed directories in one call, so index_files can spread them over workers
+        paths = [os.path.normpath(os.path.join(base_dir, rel, name)) for rel, names in changed.items() for name in names]
+        rows = iter(index_files(paths))
+        for rel, names in changed.items():
+            new[rel]['rows'] = [row for _, row in zip(names, rows) if row is not None]
+
+            # index_files may have written into the directory (transcoded files, ...), keep the
+            # state after indexing so that doesn't count as a change next time
+            stat = os.stat(base_dir / rel)
+            new[rel].update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+        tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'params': params, 'dirs': new}, f)
+        os.replace(tmp_path, manifest_path)
+
+    return pd.DataFrame([row for rel in sorted(new) for row in new[rel]['rows']])
+
+
+def _scan(path, rel, old, new, changed, suffixes):
+    stat = os.stat(path)
+    entry = old.get(rel)
+
+    if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+        # Adding, removing or renaming an entry updates the directory's mtime, list it again
+        dirs, files = [], []
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    dirs.append(e.name)
+                elif e.name.endswith(suffixes):
+                    files.append(e.name)
+        entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'dirs': sorted(dirs), 'rows': []}
+        changed[rel] = sorted(files)
+
+    new[rel] = entry
+    for name in entry['dirs']:
+        _scan(os.path.join(path, name), os.path.normpath(os.path.join(rel, name)), old, new, changed, suffixes)
@@ -0,0 +1,107 @@
+import os
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import librosa
+from tqdm import tqdm
+
+# The decoded audio of every source clip is packed back to back into one raw float32 file,
+# with a CSV index holding the sample offset and length of each clip
+SAMPLES_FILE = 'samples.f32'
+INDEX_FILE = 'index.csv'
+
+
+class AudioStore:
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        index = pd.read_csv(self.store_dir / INDEX_FILE)
+        self.sr = int(index['sr'].iloc[0]) if len(index) else None
+        self.index = dict(zip(index['path'], zip(index['offset'], index['length'])))
+        self._samples = None
+
+    @property
+    def samples(self):
+        # Opened lazily so the store can be sent to worker processes without copying the audio
+        if self._samples is None:
+            samples_path = self.store_dir / SAMPLES_FILE
+            if os.path.getsize(samples_path) == 0:
+                self._samples = np.zeros(0, dtype=np.float32)
+            else:
+                self._samples = np.memmap(samples_path, dtype=np.float32, mode='r')
+        return self._samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_samples'] = None
+        return state
+
+    def __contains__(self, path):
+        return str(path) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, path):
+        # Returns a read-only view into the memory-mapped file, nothing is copied
+        offset, length = self.index[str(path)]
+        return self.samples[offset:offset + length]
+
+
+def _decode(path, sr):
+    try:
+        y, _ = librosa.load(path, sr=sr, mono=True)
+        return y.astype(np.float32, copy=False)
+    except Exception as e:
+        print(f"Could not decode {path}. Reason: {e}")
+        return None
+
+
+def build_audio_store(df, store_dir, sr=44100, n_workers=None):
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    samples_path = store_dir / SAMPLES_FILE
+    index_path = store_dir / INDEX_FILE
+
+    # Reuse whatever was decoded by an earlier run and only decode the new sources
+    if index_path.exists():
+        index = pd.read_csv(index_path)
+        if len(index) and int(index['sr'].iloc[0]) != sr:
+            raise ValueError(f"Audio store at {store_dir} was built with sr={index['sr'].iloc[0]}, not sr={sr}")
+    else:
+        index = pd.DataFrame(columns=['path', 'offset', 'length', 'sr'])
+        open(samples_path, 'wb').close()
+
+    known = set(index['path'])
+    paths = [p for p in dict.fromkeys(df['path'].astype(str)) if p not in known]
+
+    if not paths:
+        print("Audio store is up to date")
+        return AudioStore(store_dir)
+
+    offset = os.path.getsize(samples_path) // np.dtype(np.float32).itemsize
+    new_rows = []
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor, open(samples_path, 'ab') as f:
+        decoded = executor.map(_decode, paths, [sr] * len(paths), chunksize=16)
+        for path, y in tqdm(zip(paths, decoded), total=len(paths), desc="Decoding source clips"):
+            if y is None:
+                continue
+            f.write(y.tobytes())
+            new_rows.append({'path': path, 'offset': offset, 'length': len(y), 'sr': sr})
+            offset += len(y)
+
+    new_index = pd.DataFrame(new_rows, columns=['path', 'offset', 'length', 'sr'])
+    index = pd.concat([index, new_index], ignore_index=True) if len(index) else new_index
+    index.to_csv(index_path, index=False)
+
+    return AudioStore(store_dir)
+
+
+def load_clip(path, sr=44100, audio_store=None):
+    # Read from the store when the clip is in it, otherwise decode the file
+    if audio_store is not None and path in audio_store and audio_store.sr == sr:
+        return audio_store.get(path)
+    y, _ = librosa.load(path, sr=sr)
+    return y
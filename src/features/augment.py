@@ -0,0 +1,217 @@
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import librosa
+
+from src.features.noise_bank import NoiseBank
+
+NOISE_TYPES = ['white', 'pink', 'custom', 'brownian']
+
+
+def _scale_by_variance(y, amount):
+    return y * (1 + amount * np.var(y, axis=-1, keepdims=True))
+
+
+def _normalize(y):
+    return librosa.util.normalize(y, axis=-1)
+
+
+def _preemphasis(y, coef=0.97):
+    return librosa.effects.preemphasis(y, coef=coef)
+
+
+def _median_filter(x, width, axis):
+    # Running median along one axis with 'reflect' edges, like scipy.ndimage.median_filter with a
+    # 1-D kernel, but a partition over a strided window view is several times faster
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (width // 2, width // 2)
+    windows = sliding_window_view(np.pad(x, pad, mode='symmetric'), width, axis=axis)
+    return np.partition(windows, width // 2, axis=-1)[..., width // 2]
+
+
+def hpss(S, kernel_size=31, power=2.0):
+    # Harmonic/percussive separation of a complex spectrogram, or a stack of them, with the soft
+    # masks of librosa.decompose.hpss
+    magnitude, phase = librosa.magphase(S)
+    harmonic = np.empty_like(magnitude)
+    percussive = np.empty_like(magnitude)
+    # One spectrogram at a time keeps the window views small
+    for i in np.ndindex(magnitude.shape[:-2]):
+        harmonic[i] = _median_filter(magnitude[i], kernel_size, axis=-1)
+        percussive[i] = _median_filter(magnitude[i], kernel_size, axis=-2)
+
+    mask_harmonic = librosa.util.softmask(harmonic, percussive, power=power, split_zeros=True)
+    mask_percussive = librosa.util.softmask(percussive, harmonic, power=power, split_zeros=True)
+    return magnitude * mask_harmonic * phase, magnitude * mask_percussive * phase
+
+
+# The effects 'wildcard' picks one of for every clip, applied mildly to not bias the genre
+WILDCARD_EFFECTS = [
+    lambda y: y,
+    lambda y: _preemphasis(y, coef=0.98),
+    lambda y: _scale_by_variance(y, 0.2),
+    _normalize,
+]
+
+
+class AugmentationEngine:
+    # Applies the genre adjustments, speed variation, slice reassembly and noise of the mixer to all
+    # source clips of a mix at once. Clips of equal length are stacked into an (N, samples) array,
+    # each transform runs once per stack, and clips that need a spectrogram (HPSS for folk, harmonic
+    # extraction for pop, time stretching) share a single STFT and ISTFT. Noise windows come from a
+    # NoiseBank. The time spent in every transform is added up in `timings`
+    def __init__(self, noise_bank=None, n_fft=2048, hop_length=512):
+        self.noise_bank = noise_bank if noise_bank is not None else NoiseBank()
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.timings = defaultdict(float)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def pop_timings(self):
+        # Returns the seconds spent per transform since the last call and starts counting from zero
+        timings, self.timings = dict(self.timings), defaultdict(float)
+        return timings
+
+    def apply(self, clips, genre, rng=np.random, speed_range=(0.9, 1.1), snr=20):
+        # Returns the augmented clips in the order they were given, they may change length when stretched
+        augmented = [None] * len(clips)
+        by_length = defaultdict(list)
+        for i, clip in enumerate(clips):
+            by_length[len(clip)].append(i)
+
+        for indices in by_length.values():
+            batch = np.stack([clips[i] for i in indices]).astype(np.float32)
+            for i, clip in zip(indices, self._apply_batch(batch, genre, rng, speed_range, snr)):
+                augmented[i] = clip
+        return augmented
+
+    def _apply_batch(self, batch, genre, rng, speed_range, snr):
+        n, length = batch.shape
+
+        # Draw every random decision for the batch up front
+        effects = rng.randint(len(WILDCARD_EFFECTS), size=n)
+        stretch = rng.random_sample(n) < 0.5
+        rates = rng.uniform(*speed_range, size=n)
+        reassemble = rng.random_sample(n) < 0.3
+        noisy = rng.random_sample(n) < 0.5
+        noise_types = rng.choice(NOISE_TYPES, size=n)
+
+        with self._timed('adjust_for_genre'):
+            batch = self._adjust_for_genre(batch, genre, effects)
+
+        clips = self._spectral(batch, genre, stretch, rates)
+
+        if genre == 'pop':
+            # The last pre-emphasis of pop comes after the harmonic mix-in, so after the ISTFT
+            with self._timed('adjust_for_genre'):
+                clips = [_preemphasis(clip, coef=0.97) for clip in clips]
+
+        with self._timed('random_slice_reassemble'):
+            # Shuffling the slices doesn't change their sum, so this is just the sum of the slices
+            clips = [self._reassemble(clip) if r else clip for clip, r in zip(clips, reassemble)]
+
+        with self._timed('add_noise'):
+            clips = [self._add_noise(clip, noise_type, snr, rng) if add else clip
+                     for clip, add, noise_type in zip(clips, noisy, noise_types)]
+
+        return clips
+
+    def _adjust_for_genre(self, batch, genre, effects):
+        if genre == 'classical':
+            # Increase dynamic range; classical music often has wide dynamic swings
+            batch = _scale_by_variance(batch, 1)
+        elif genre == 'rock':
+            # Apply compression to decrease dynamic range; rock music often has a compressed, upfront sound
+            batch = _preemphasis(batch)
+        elif genre == 'jazz':
+            # Slightly increase dynamic range and a slight pre-emphasis to emulate live jazz environments
+            batch = _preemphasis(_scale_by_variance(batch, 0.5), coef=0.97)
+        elif genre == 'blues':
+            # Apply mild compression and a warmer tone by reducing high frequencies
+            batch = _preemphasis(batch, coef=0.95)
+        elif genre in ('electronic', 'pop'):
+            # Normalize to ensure uniform loudness levels, pop continues in the spectral stage
+            batch = _normalize(batch)
+            if genre == 'pop':
+                batch = _preemphasis(batch, coef=0.98)
+        elif genre == 'world':
+            # Apply a slight increase in dynamic range to reflect diverse instrumentation and spaces
+            batch = _scale_by_variance(batch, 0.3)
+        elif genre == 'wildcard':
+            batch = batch.copy()
+            for effect, fn in enumerate(WILDCARD_EFFECTS):
+                if (effects == effect).any():
+                    batch[effects == effect] = fn(batch[effects == effect])
+        # folk is handled in the spectral stage
+        return batch
+
+    def _spectral(self, batch, genre, stretch, rates):
+        length = batch.shape[1]
+        clips = list(batch)
+        needs_stft = np.ones(len(batch), dtype=bool) if genre in ('folk', 'pop') else stretch
+        if not needs_stft.any():
+            return clips
+
+        rows = np.flatnonzero(needs_stft)
+        with self._timed('stft'):
+            S = librosa.stft(batch[rows], n_fft=self.n_fft, hop_length=self.hop_length)
+
+        if genre == 'folk':
+            # Keep the percussive part
+            with self._timed('hpss'):
+                S = hpss(S)[1]
+        elif genre == 'pop':
+            # Mix in a little of the harmonic part
+            with self._timed('harmonic'):
+                S = S + 0.1 * hpss(S)[0]
+
+        stretched = {}
+        with self._timed('vary_speed'):
+            for j, i in enumerate(rows):
+                if stretch[i]:
+                    stretched[j] = librosa.phase_vocoder(S[j], rate=rates[i], hop_length=self.hop_length, n_fft=self.n_fft)
+
+        with self._timed('istft'):
+            # Rows of the same length go through one batched ISTFT, stretched rows one by one
+            unstretched = [j for j in range(len(rows)) if j not in stretched]
+            if unstretched:
+                y = librosa.istft(S[unstretched], hop_length=self.hop_length, n_fft=self.n_fft, length=length)
+                for j, clip in zip(unstretched, y):
+                    clips[rows[j]] = clip
+            for j, D in stretched.items():
+                clips[rows[j]] = librosa.istft(D, hop_length=self.hop_length, n_fft=self.n_fft,
+                                               length=int(round(length / rates[rows[j]])))
+        return clips
+
+    @staticmethod
+    def _reassemble(clip, num_slices=4):
+        slice_length = len(clip) // num_slices
+        return clip[:slice_length * num_slices].reshape(num_slices, slice_length).sum(axis=0)
+
+    def _add_noise(self, clip, noise_type, snr, rng, max_attempts=3):
+        if noise_type not in self.noise_bank:
+            return clip
+        # A recording can have stretches of silence longer than the clip, a silent window can't be
+        # scaled to the SNR, so another one is drawn
+        for _ in range(max_attempts):
+            noise = self.noise_bank.draw(noise_type, len(clip), rng)
+            noise_power = np.mean(noise ** 2)
+            if noise_power > 0:
+                break
+        else:
+            # Only silent windows were drawn, the clip stays without noise
+            return clip
+
+        sig_power = np.mean(clip ** 2)
+        scale = (sig_power / noise_power) / (10 ** (snr / 10))
+        return clip + noise * np.sqrt(scale)
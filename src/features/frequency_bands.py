@@ -0,0 +1,84 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import librosa
+from tqdm import tqdm
+
+from src.features.audio_store import load_clip
+from src.features.spectrogram import stft
+
+# Frequency ranges (Hz) used to sort the source clips
+FREQUENCY_RANGES = {
+    'sub_bass': (20, 60),
+    'bass': (60, 250),
+    'low_midrange': (250, 500),
+    'midrange': (500, 2000),
+    'upper_midrange': (2000, 4000),
+    'presence': (4000, 6000),
+    'brilliance': (6000, 20000),
+}
+
+BAND_ENERGY_COLUMNS = [f'band_energy_{name}' for name in FREQUENCY_RANGES]
+
+
+def band_matrix(sr=44100, n_fft=2048, ranges=FREQUENCY_RANGES):
+    # Matrix mapping each STFT bin to the band its centre frequency falls in, shape (n_bands, n_bins)
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+    return np.stack([(freqs >= low) & (freqs < high) for low, high in ranges.values()]).astype(np.float32)
+
+
+def band_energies(y, sr=44100, n_fft=2048, bands=None):
+    if bands is None:
+        bands = band_matrix(sr, n_fft)
+
+    # Sum the magnitude spectrum over time first, then fold the bins into bands in one multiply
+    spectrum = np.abs(stft(y, n_fft=n_fft, hop_length=n_fft // 4)).sum(axis=1)
+    return bands @ spectrum
+
+
+# State shared by all clips profiled in one process, set once by the pool initializer
+_profile_worker_state = {}
+
+
+def _init_profile_worker(sr, n_fft, audio_store):
+    # The band matrix is built once per process and reused for every clip
+    _profile_worker_state.update(sr=sr, n_fft=n_fft, audio_store=audio_store, bands=band_matrix(sr, n_fft))
+
+
+def _profile_clip(path):
+    state = _profile_worker_state
+    try:
+        y = load_clip(path, sr=state['sr'], audio_store=state['audio_store'])
+        return band_energies(y, state['sr'], state['n_fft'], state['bands'])
+    except Exception as e:
+        print(f"Could not profile {path}. Reason: {e}")
+        return np.full(len(state['bands']), np.nan, dtype=np.float32)
+
+
+def profile_frequency_bands(df, sr=44100, n_fft=2048, audio_store=None, n_workers=None):
+    paths = df['path'].astype(str).tolist()
+    init_args = (sr, n_fft, audio_store)
+
+    if n_workers is None or n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_profile_worker, initargs=init_args) as executor:
+            energies = list(tqdm(executor.map(_profile_clip, paths, chunksize=32),
+                                 total=len(paths), desc="Profiling frequency bands"))
+    else:
+        _init_profile_worker(*init_args)
+        energies = [_profile_clip(path) for path in tqdm(paths, desc="Profiling frequency bands")]
+
+    energies = np.stack(energies) if energies else np.zeros((0, len(FREQUENCY_RANGES)), dtype=np.float32)
+
+    # Store each band's share of the total energy, so clips of different loudness can be compared
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = energies / energies.sum(axis=1, keepdims=True)
+
+    profile = pd.DataFrame(shares, columns=BAND_ENERGY_COLUMNS, index=df.index)
+    
+    # Clips that could not be decoded, and silent clips, have NaN shares and get no frequency range
+    band_names = list(FREQUENCY_RANGES)
+    dominant = np.nan_to_num(shares, nan=-1).argmax(axis=1)
+    profile['frequency_range'] = [None if np.isnan(row).all() else band_names[i] for i, row in zip(dominant, shares)]
+
+    return profile
@@ -1,13 +1,18 @@
 import os
+import csv
 from pathlib import Path
 import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import imageio
 import librosa
-from matplotlib import cm
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from src.data.catalog import catalog_exists, load_catalog, add_columns
+from src.features.spectrogram import SPECTROGRAM_PARAMS, normalized_log_mel, fixed_length, colorize
+
 def clear_directory(folder_path):
     # Check if the directory exists
     if not os.path.exists(folder_path):
@@ -27,66 +32,144 @@ def clear_directory(folder_path):
         except Exception as e:
             print(f'Failed to delete {file_path}. Reason: {e}')
 
-def generate_spectrograms(df, output_dir, fixed_length_seconds=3):
+MANIFEST_FILE = 'spectrograms_manifest.csv'
+
+# With output_format='array' all spectrograms go into this one (n_clips, n_mels, n_frames) float16 array
+ARRAY_FILE = 'spectrograms.npy'
+
+def generate_spectrograms(df, output_dir, fixed_length_seconds=3, n_workers=1, resume=False, output_format='png'):
+    if output_format not in ('png', 'array'):
+        raise ValueError(f"Unknown output format {output_format}, expected 'png' or 'array'")
+    
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-        
-    clear_directory(output_dir)
     
-    # Sample rate
-    sr = 44100  
-    # Calculate fixed length in samples
-    fixed_length_samples = int(fixed_length_seconds * sr)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    array_path = os.path.join(output_dir, ARRAY_FILE)
+    
+    params = dict(SPECTROGRAM_PARAMS, fixed_length_seconds=fixed_length_seconds)
+    fixed_length_samples = int(fixed_length_seconds * params['sr'])
+    array_shape = (len(df), params['n_mels'], 1 + fixed_length_samples // params['hop_length'])
+    
+    # An existing array can only be resumed into if it still has one row per clip
+    if resume and output_format == 'array' and os.path.exists(array_path):
+        resume = np.load(array_path, mmap_mode='r').shape == array_shape
+    
+    if resume and os.path.exists(manifest_path):
+        # The last entry for a file wins, earlier ones were overwritten
+        manifest = pd.read_csv(manifest_path, dtype=str).drop_duplicates('file_name', keep='last')
+        done = dict(zip(manifest['file_name'], manifest['source_hash']))
+    else:
+        clear_directory(output_dir)
+        done = {}
+    
+    if output_format == 'array' and not os.path.exists(array_path):
+        # A new array has no rows yet, whatever an old manifest says, so every clip is computed again
+        done = {}
+        np.lib.format.open_memmap(array_path, mode='w+', dtype=np.float16, shape=array_shape).flush()
+    
+    init_args = (str(output_dir), params, done, output_format)
+    paths = df['path'].astype(str).tolist()
     
     # Initialize an empty list to store spectrogram paths
     spectrogram_paths = []
+    n_skipped = 0
     
-    for index, row in tqdm(df.iterrows(), desc='Generating spectrograms', total=len(df)):
-        # Load the audio file
-        y, sr = librosa.load(row['path'], sr=sr, mono=True)
+    with open(manifest_path, 'a', newline='') as manifest_file:
+        # File names can contain commas and quotes, the csv writer quotes them so pandas reads them back
+        manifest_writer = csv.writer(manifest_file)
+        if manifest_file.tell() == 0:
+            manifest_writer.writerow(['file_name', 'source_hash'])
         
-        if len(y) < fixed_length_samples:
-            # Calculate the amount of silence needed
-            padding_needed = fixed_length_samples - len(y)
-            # Generate a random offset for the silence padding
-            offset = np.random.randint(0, padding_needed)
-            
-            # Pad the audio signal with silence before and after based on the random offset
-            silence_before = np.zeros(offset)
-            silence_after = np.zeros(padding_needed - offset)
-            y_padded = np.concatenate((silence_before, y, silence_after))
+        if n_workers is None or n_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_spectrogram_worker, initargs=init_args)
+            results = executor.map(_spectrogram_for_clip, range(len(paths)), paths, chunksize=16)
         else:
-            # If the audio is longer than the fixed length, truncate it
-            y_padded = y[:fixed_length_samples]
-        
-        # Generate the spectrogram
-        mel_spec = librosa.feature.melspectrogram(y=y_padded, sr=sr, n_mels=128, fmax=22000)
-        log_mel_spec = librosa.power_to_db(mel_spec, ref=np.max)
-        
-        # Normalize the spectrogram
-        norm_log_mel_spec = (log_mel_spec - log_mel_spec.min()) / (log_mel_spec.max() - log_mel_spec.min())
-        
-        # Apply a colormap
-        colored_spec = cm.viridis(norm_log_mel_spec)
+            executor = None
+            _init_spectrogram_worker(*init_args)
+            results = map(_spectrogram_for_clip, range(len(paths)), paths)
         
-        # Convert to RGB
-        colored_spec_rgb = (colored_spec[..., :3] * 255).astype(np.uint8)
-
-        # Define the file name and save path
-        file_name = os.path.basename(row['path']).replace('.wav', '_spectrogram.png')
-        save_path = os.path.join(output_dir, file_name)
-        
-        # Save the spectrogram image
-        imageio.imwrite(save_path, colored_spec_rgb)
-        
-        # Append the save path to the list
-        spectrogram_paths.append(save_path)
+        try:
+            for key, save_path, source_hash, rendered in tqdm(results, desc='Generating spectrograms', total=len(paths)):
+                # Record every finished spectrogram straight away, so a crash loses no finished work
+                if rendered:
+                    manifest_writer.writerow([key, source_hash])
+                    manifest_file.flush()
+                else:
+                    n_skipped += 1
+                
+                # Append the save path to the list
+                spectrogram_paths.append(save_path)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    
+    if resume:
+        print(f"Skipped {n_skipped} spectrograms that were already up to date")
     
     # Add the list as a new column to the DataFrame
     df['spectrogram_path'] = spectrogram_paths
+    
+    # In the array store, each clip's spectrogram is the row with the same position as the clip
+    if output_format == 'array':
+        df['spectrogram_index'] = np.arange(len(df))
 
     return df  # Return the updated DataFrame
 
+# State shared by all spectrograms rendered in one process, set once by the pool initializer
+_spectrogram_worker_state = {}
+
+def _init_spectrogram_worker(output_dir, params, done, output_format):
+    _spectrogram_worker_state.update(output_dir=output_dir, params=params, done=done, output_format=output_format)
+    
+    if output_format == 'array':
+        # Every process writes its own rows straight into the shared memory-mapped array
+        _spectrogram_worker_state['array'] = np.load(os.path.join(output_dir, ARRAY_FILE), mmap_mode='r+')
+
+def source_hash(audio_path, params):
+    # Hash of the audio file content together with the spectrogram parameters
+    h = hashlib.sha1(repr(sorted(params.items())).encode())
+    with open(audio_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _spectrogram_for_clip(index, audio_path):
+    state = _spectrogram_worker_state
+    params = state['params']
+    
+    # Define the file name and save path
+    if state['output_format'] == 'array':
+        key = str(index)
+        save_path = os.path.join(state['output_dir'], ARRAY_FILE)
+    else:
+        key = os.path.basename(audio_path).replace('.wav', '_spectrogram.png')
+        save_path = os.path.join(state['output_dir'], key)
+    
+    clip_hash = source_hash(audio_path, params)
+    
+    # Skip spectrograms that already exist for the same audio and parameters
+    if state['done'].get(key) == clip_hash and os.path.exists(save_path):
+        return key, save_path, clip_hash, False
+    
+    # Load the audio file
+    y, sr = librosa.load(audio_path, sr=params['sr'], mono=True)
+    
+    # The random offset for the silence padding is seeded by the clip, so reruns give the same image
+    y = fixed_length(y, int(params['fixed_length_seconds'] * params['sr']), seed=int(clip_hash[:8], 16))
+    norm_log_mel_spec = normalized_log_mel(y, params)
+    
+    if state['output_format'] == 'array':
+        # Store the normalized log-mel as is, without a colormap. The row lands in the shared page
+        # cache right away, so it survives this process crashing even before the array is flushed
+        state['array'][index] = norm_log_mel_spec.astype(np.float16)
+        return key, save_path, clip_hash, True
+    
+    # Save the spectrogram image
+    imageio.imwrite(save_path, colorize(norm_log_mel_spec))
+    
+    return key, save_path, clip_hash, True
+
 if __name__ == '__main__':
     # Get the directory containing this script
     script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
@@ -96,17 +179,18 @@ if __name__ == '__main__':
     
     SPEC_DIR = project_root / 'data' / 'processed' / 'mixed_audio_clips' /'spectrograms'
     
-    metadata_path = project_root / 'data' / 'processed' / 'mixed_audio_clips' / 'mixed_clips_df.csv'
+    CATALOG_DIR = project_root / 'data' / 'processed' / 'mixed_audio_clips' / 'catalog'
     
-    # Check if metadata file exists
-    if os.path.exists(metadata_path):
-        metadata = pd.read_csv(metadata_path)
+    # Check if the catalog of mixed clips exists
+    if catalog_exists(CATALOG_DIR):
+        metadata = load_catalog(CATALOG_DIR)
         
-        # Check if 'spectrogram_path' column exists, if not, generate spectrograms
+        # Check if 'spectrogram_path' column exists, if not, generate spectrograms.
+        # Spectrograms left over from an interrupted run are reused if their source is unchanged
         if 'spectrogram_path' not in metadata.columns:
-            metadata = generate_spectrograms(metadata, SPEC_DIR)
-        
-        # Save updated metadata
-        metadata.to_csv(metadata_path, index=False)
+            metadata = generate_spectrograms(metadata, SPEC_DIR, n_workers=os.cpu_count(), resume=True)
+            
+            # Only the new columns are written to the catalog
+            add_columns(CATALOG_DIR, metadata[[c for c in ('spectrogram_path', 'spectrogram_index') if c in metadata.columns]])
     else:
-        print(f"Metadata file not found at {metadata_path}, make sure to run the 'mix_audio_clips.py' script first.")
\ No newline at end of file
+        print(f"Catalog not found at {CATALOG_DIR}, make sure to run the 'mix_audio_clips.py' script first.")
@@ -3,40 +3,69 @@ import random
 import shutil
 import numpy as np
 import os
+import time
 import pandas as pd
 
 import librosa
 import soundfile as sf
-import colorednoise as cn
+import imageio
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 from src.data.download_data import download_all
-
-def determine_frequency_range(audio_path, sr=44100):
+from src.data.catalog import catalog_exists, save_catalog, load_catalog, add_columns, add_audio_info
+from src.features.audio_store import build_audio_store, load_clip
+from src.features.sampling_index import SamplingIndex
+from src.features.augment import AugmentationEngine
+from src.features.noise_bank import NoiseBank
+from src.features.generate_spectrograms import ARRAY_FILE
+from src.features.spectrogram import SPECTROGRAM_PARAMS, normalized_log_mel, fixed_length, colorize
+from src.features.frequency_bands import FREQUENCY_RANGES, BAND_ENERGY_COLUMNS, band_energies, profile_frequency_bands
+
+# Random generators of the mixing and augmentation code when the caller doesn't pass its own. These
+# are kept separate from the global ones because librosa draws from the global `random` module on its
+# first time_stretch call, which would make seeded runs depend on what the process has done before.
+# Seeded mixes get their own generators instead, see _mix_clip
+_rng = random.Random()
+_np_rng = np.random.RandomState()
+
+INSTRUMENTS = ['Hi-hat', 'Saxophone', 'Trumpet' ,'Glockenspiel' ,'Cello', 'Clarinet',
+               'Snare_drum', 'Oboe' ,'Flute', 'Chime' ,'Bass_drum', 'Harmonica', 'Gong',
+               'Double_bass', 'Tambourine' ,'Cowbell' ,'Electric_piano', 'Acoustic_guitar',
+               'Violin_or_fiddle' ,'Finger_snapping', 'Vocal' ,'Guitar' ,'Drums', 'Piano',
+               'Organ', 'Electric_guitar' ,'Tuba', 'Bassoon', 'Drum', 'Percussion_Other',
+               'Percussive_Bells', 'Shaker' ,'Cymbal', 'Whistle' ,'Triangle', 'Wind_chimes',
+               'Woodblock', 'French_horn', 'Trombone', 'Mandolin' ,'Contrabassoon',
+               'English_horn' ,'Violin' ,'Viola', 'Banjo'
+               ]
+
+# Instruments a mix of each genre draws from
+GENRE_INSTRUMENTS = {
+    'jazz': ['Saxophone', 'Trumpet', 'Double_bass', 'Clarinet', 'Trombone', 'Snare_drum', 'Bass_drum', 'Piano', 'Electric_piano'],
+    'classical': ['Violin', 'Viola', 'Cello', 'Double_bass', 'Flute', 'Oboe', 'Clarinet', 'Bassoon', 'Contrabassoon', 'English_horn', 'French_horn', 'Trombone', 'Tuba', 'Organ', 'Piano', 'Glockenspiel', 'Percussive_Bells'],
+    'rock': ['Electric_guitar', 'Drums', 'Bass_drum', 'Snare_drum', 'Electric_piano', 'Acoustic_guitar', 'Piano'],
+    'blues': ['Harmonica', 'Acoustic_guitar', 'Electric_guitar', 'Piano', 'Drums'],
+    'folk': ['Acoustic_guitar', 'Banjo', 'Mandolin', 'Violin_or_fiddle', 'Harmonica'],
+    'electronic': ['Electric_piano', 'Synthesizer', 'Drum_machine'],
+    'world': ['Shaker', 'Gong', 'Wind_chimes', 'Woodblock', 'Triangle', 'Tambourine', 'Drums', 'Percussion_Other'],
+    'wildcard':INSTRUMENTS,
+    'pop': ['Vocal', 'Electric_guitar', 'Acoustic_guitar', 'Piano', 'Electric_piano', 'Synthesizer', 'Drums', 'Bass_drum', 'Snare_drum', 'Finger_snapping', 'Guitar']
+}
+
+def determine_frequency_range(audio_path, sr=44100, audio_store=None):
     # Load the audio file
-    y, sr = librosa.load(audio_path, sr=sr)
-    
-    # Compute the short-time Fourier transform (STFT)
-    D = np.abs(librosa.stft(y))
-    
-    # Define the frequency ranges
-    ranges = {
-        'sub_bass': (20, 60),
-        'bass': (60, 250),
-        'low_midrange': (250, 500),
-        'midrange': (500, 2000),
-        'upper_midrange': (2000, 4000),
-        'presence': (4000, 6000),
-        'brilliance': (6000, 20000),
-    }
+    y = load_clip(audio_path, sr=sr, audio_store=audio_store)
     
     # Compute the spectral energy in each range
-    energy = {name: D[int(low / sr * D.shape[0]):int(high / sr * D.shape[0])].sum()
-              for name, (low, high) in ranges.items()}
+    energy = band_energies(y, sr)
+    
+    # A silent clip has no dominant frequency range, like in profile_frequency_bands
+    if not energy.sum() > 0:
+        return None
     
     # Determine the dominant frequency range
-    return max(energy, key=energy.get)
+    return list(FREQUENCY_RANGES)[int(np.argmax(energy))]
 
 def mix_audio_clips(clip_paths, output_path, sr=44100):
     # Load the first clip
@@ -61,31 +90,11 @@ def map_instrument_labels(row, instrument_map):
     generalized_labels = set(instrument_map[label] for label in labels if label in instrument_map)
     return ', '.join(generalized_labels)
 
-def generate_mixed_audio_clips(df, output_folder, n_clips, sr=44100, clip_length=3):
-    
-    instruments = ['Hi-hat', 'Saxophone', 'Trumpet' ,'Glockenspiel' ,'Cello', 'Clarinet',
-                 'Snare_drum', 'Oboe' ,'Flute', 'Chime' ,'Bass_drum', 'Harmonica', 'Gong',
-                'Double_bass', 'Tambourine' ,'Cowbell' ,'Electric_piano', 'Acoustic_guitar',
-                'Violin_or_fiddle' ,'Finger_snapping', 'Vocal' ,'Guitar' ,'Drums', 'Piano',
-                'Organ', 'Electric_guitar' ,'Tuba', 'Bassoon', 'Drum', 'Percussion_Other',
-                'Percussive_Bells', 'Shaker' ,'Cymbal', 'Whistle' ,'Triangle', 'Wind_chimes',
-                'Woodblock', 'French_horn', 'Trombone', 'Mandolin' ,'Contrabassoon',
-                'English_horn' ,'Violin' ,'Viola', 'Banjo'
-                ]
-    
-    
-    genre_instruments = {
-        'jazz': ['Saxophone', 'Trumpet', 'Double_bass', 'Clarinet', 'Trombone', 'Snare_drum', 'Bass_drum', 'Piano', 'Electric_piano'],
-        'classical': ['Violin', 'Viola', 'Cello', 'Double_bass', 'Flute', 'Oboe', 'Clarinet', 'Bassoon', 'Contrabassoon', 'English_horn', 'French_horn', 'Trombone', 'Tuba', 'Organ', 'Piano', 'Glockenspiel', 'Percussive_Bells'],
-        'rock': ['Electric_guitar', 'Drums', 'Bass_drum', 'Snare_drum', 'Electric_piano', 'Acoustic_guitar', 'Piano'],
-        'blues': ['Harmonica', 'Acoustic_guitar', 'Electric_guitar', 'Piano', 'Drums'],
-        'folk': ['Acoustic_guitar', 'Banjo', 'Mandolin', 'Violin_or_fiddle', 'Harmonica'],
-        'electronic': ['Electric_piano', 'Synthesizer', 'Drum_machine'],
-        'world': ['Shaker', 'Gong', 'Wind_chimes', 'Woodblock', 'Triangle', 'Tambourine', 'Drums', 'Percussion_Other'],
-        'wildcard':instruments,
-        'pop': ['Vocal', 'Electric_guitar', 'Acoustic_guitar', 'Piano', 'Electric_piano', 'Synthesizer', 'Drums', 'Bass_drum', 'Snare_drum', 'Finger_snapping', 'Guitar']
-    }
-
+def generate_mixed_audio_clips(df, output_folder, n_clips, sr=44100, clip_length=3, n_workers=1, seed=None, audio_store=None, sampling_index=None, noise_bank=None,
+                               spectrogram_dir=None, spectrogram_format='array', write_wav=None):
+    # With a spectrogram_dir the spectrograms are computed from the mixes in memory and written there
+    # (as one array or as PNGs), and the WAVs are only written when write_wav is set. Without one,
+    # only the WAVs are written and generate_spectrograms renders them later
     
     # Map instruments to more general categories
     instrument_map = {  # Not sure if were actually using this, but keeping it here for now
@@ -102,21 +111,124 @@ def generate_mixed_audio_clips(df, output_folder, n_clips, sr=44100, clip_length
 
     #df['generalized_label'] = df.apply(map_instrument_labels(instrument_map), axis=1)
     
+    if spectrogram_format not in ('png', 'array'):
+        raise ValueError(f"Unknown spectrogram format {spectrogram_format}, expected 'png' or 'array'")
+    if write_wav is None:
+        write_wav = spectrogram_dir is None
+    
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    elif os.listdir(output_folder):
+    elif os.listdir(output_folder) and write_wav:
         clear_directory(output_folder)
+    
+    spectrogram_params = None
+    if spectrogram_dir is not None:
+        spectrogram_params = dict(SPECTROGRAM_PARAMS, fixed_length_seconds=clip_length)
+        if spectrogram_params['sr'] != sr:
+            raise ValueError(f"Spectrograms are computed at sr={spectrogram_params['sr']}, can't mix at sr={sr}")
+        
+        os.makedirs(spectrogram_dir, exist_ok=True)
+        clear_directory(spectrogram_dir)
+        if spectrogram_format == 'array':
+            n_frames = 1 + int(clip_length * sr) // spectrogram_params['hop_length']
+            np.lib.format.open_memmap(os.path.join(spectrogram_dir, ARRAY_FILE), mode='w+', dtype=np.float16,
+                                      shape=(n_clips, spectrogram_params['n_mels'], n_frames)).flush()
+
+    # Every clip gets its own seed derived from the base seed, so the output only
+    # depends on the seed and the clip index, not on how the clips are spread over workers
+    clip_seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(n_clips)]
+    clip_indices = range(n_clips)
+    
+    # Group the source clips once, the workers get this index instead of the metadata frame
+    if sampling_index is None:
+        sampling_index = SamplingIndex.from_frame(df, GENRE_INSTRUMENTS)
+
+    init_args = (sampling_index, str(output_folder), sr, clip_length, audio_store, noise_bank,
+                 write_wav, str(spectrogram_dir) if spectrogram_dir is not None else None,
+                 spectrogram_params, spectrogram_format)
+
+    if n_workers is None or n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_mix_worker, initargs=init_args) as executor:
+            chunksize = max(1, n_clips // ((n_workers or os.cpu_count()) * 16))
+            results = list(tqdm(executor.map(_mix_clip, clip_indices, clip_seeds, chunksize=chunksize),
+                                total=n_clips, desc="Generating mixed clips"))
+    else:
+        _init_mix_worker(*init_args)
+        # Wrap the range function with tqdm to display a progress bar
+        results = [_mix_clip(i, clip_seed) for i, clip_seed in tqdm(zip(clip_indices, clip_seeds), total=n_clips, desc="Generating mixed clips")]
 
-    mixed_clips_info = []
-
-    # Wrap the range function with tqdm to display a progress bar
-    for i in tqdm(range(n_clips), desc="Generating mixed clips"):
-        labels, genre, output_path = mix_clips_from_different_ranges(df, genre_instruments, f"{output_folder}/mixed_clip_{i}", sr, clip_length)
-        if labels and output_path:
-            mixed_clips_info.append({'path': output_path, 'labels': ', '.join(labels), 'genre': genre})
+    # Results come back in clip order regardless of which worker produced them
+    mixed_clips_info = [info for info, _ in results if info is not None]
+    
+    # Report which augmentation or output step dominates
+    timings = pd.DataFrame([t for _, t in results]).sum()
+    if len(timings):
+        print("Time per step (seconds, summed over all workers):")
+        for name, seconds in timings.sort_values(ascending=False).items():
+            print(f"  {name:<24}{seconds:8.1f}s {seconds / timings.sum():6.1%}")
 
     return pd.DataFrame(mixed_clips_info)
 
+# State shared by all clips generated in one process, set once by the pool initializer
+_mix_worker_state = {}
+
+def _init_mix_worker(sampling_index, output_folder, sr, clip_length, audio_store, noise_bank,
+                     write_wav, spectrogram_dir, spectrogram_params, spectrogram_format):
+    _mix_worker_state.update(sampling_index=sampling_index, output_folder=output_folder,
+                             sr=sr, clip_length=clip_length, audio_store=audio_store,
+                             augmenter=AugmentationEngine(noise_bank), write_wav=write_wav,
+                             spectrogram_dir=spectrogram_dir, spectrogram_params=spectrogram_params,
+                             spectrogram_format=spectrogram_format)
+    
+    if spectrogram_params is not None and spectrogram_format == 'array':
+        # Every process writes its own rows straight into the shared memory-mapped array
+        _mix_worker_state['spectrograms'] = np.load(os.path.join(spectrogram_dir, ARRAY_FILE), mmap_mode='r+')
+
+_augmenter = None
+
+def _default_augmenter():
+    # The noise bank is synthesized once per process, not once per mix
+    global _augmenter
+    if _augmenter is None:
+        _augmenter = AugmentationEngine()
+    return _augmenter
+
+def _mix_clip(i, clip_seed):
+    state = _mix_worker_state
+    
+    # Both random generators of the mixing and augmentation code start from the clip's seed
+    labels, genre, mixed_clip = mix_sources(state['sampling_index'], state['sr'], state['clip_length'],
+                                            audio_store=state['audio_store'], augmenter=state['augmenter'],
+                                            rng=random.Random(clip_seed), np_rng=np.random.RandomState(clip_seed))
+    # Time spent per augmentation transform on this clip, added up by the caller
+    timings = state['augmenter'].pop_timings()
+    if not labels:
+        return None, timings
+    
+    info = {'path': None, 'labels': ', '.join(labels), 'genre': genre}
+    
+    if state['write_wav']:
+        start = time.perf_counter()
+        info['path'] = f"{state['output_folder']}/mixed_clip_{i}.wav"
+        sf.write(info['path'], mixed_clip, state['sr'])
+        timings['write_wav'] = time.perf_counter() - start
+    
+    # Fused mode: the spectrogram is computed from the mix in memory
+    params = state['spectrogram_params']
+    if params is not None:
+        start = time.perf_counter()
+        spec = normalized_log_mel(fixed_length(mixed_clip, int(params['fixed_length_seconds'] * params['sr']), seed=clip_seed), params)
+        if state['spectrogram_format'] == 'array':
+            state['spectrograms'][i] = spec.astype(np.float16)
+            info['spectrogram_path'] = os.path.join(state['spectrogram_dir'], ARRAY_FILE)
+            info['spectrogram_index'] = i
+        else:
+            info['spectrogram_path'] = os.path.join(state['spectrogram_dir'], f'mixed_clip_{i}_spectrogram.png')
+            imageio.imwrite(info['spectrogram_path'], colorize(spec))
+        timings['spectrogram'] = time.perf_counter() - start
+    
+    return info, timings
+
 def clear_directory(folder_path):
     # Check if the directory exists
     if not os.path.exists(folder_path):
@@ -136,83 +248,15 @@ def clear_directory(folder_path):
         except Exception as e:
             print(f'Failed to delete {file_path}. Reason: {e}')
 
-def adjust_for_genre(clip, genre, sr=44100):
-    if genre == 'classical':
-        # Increase dynamic range; classical music often has wide dynamic swings
-        clip = clip * (1 + np.var(clip))
-    elif genre == 'rock':
-        # Apply compression to decrease dynamic range; rock music often has a compressed, upfront sound
-        clip = librosa.effects.preemphasis(clip)
-    elif genre == 'jazz':
-        # Slightly increase dynamic range and add a subtle reverb to emulate live jazz environments
-        clip = clip * (1 + 0.5 * np.var(clip))
-        clip = librosa.effects.preemphasis(clip, coef=0.97)  # Slight pre-emphasis
-    elif genre == 'blues':
-        # Apply mild compression and a warmer tone by reducing high frequencies
-        clip = librosa.effects.preemphasis(clip, coef=0.95)
-    elif genre == 'folk':
-        # Enhance the natural dynamics and apply a gentle high-pass filter to emulate acoustic settings
-        clip = librosa.effects.hpss(clip)[1]
-    elif genre == 'electronic':
-        # Normalize to ensure uniform loudness levels typical of electronic music
-        clip = librosa.util.normalize(clip)
-    elif genre == 'world':
-        # Apply a slight increase in dynamic range and a moderate reverb to reflect diverse instrumentation and spaces
-        clip = clip * (1 + 0.3 * np.var(clip))
-    elif genre == 'wildcard':
-        # For wildcard, randomly choose to apply one of the effects mildly to not bias the genre
-        effects = [lambda x: x, lambda x: librosa.effects.preemphasis(x, coef=0.98), lambda x: x * (1 + 0.2 * np.var(x)), librosa.util.normalize]
-        clip = random.choice(effects)(clip)
-    elif genre == 'pop':
-        clip = librosa.util.normalize(clip)
-        clip = librosa.effects.preemphasis(clip, coef=0.98)
-        clip = librosa.effects.harmonic(clip) * 0.1 + clip
-        clip = librosa.effects.preemphasis(clip, coef=0.97)
-
-    return clip
-
-
-def add_noise(clip, noise_type='white', snr=20):
-    if noise_type == 'white':
-        # Generate white noise
-        noise = np.random.normal(0, 1, len(clip))
-    elif noise_type == 'pink':
-        # Generate pink noise using colorednoise
-        # The exponent for pink noise is 1, beta = 1
-        noise = cn.powerlaw_psd_gaussian(1, len(clip))
-    elif noise_type == 'brownian':
-        # Generate brownian noise using colorednoise
-        # The exponent for brownian noise is 2, beta = 2
-        noise = cn.powerlaw_psd_gaussian(2, len(clip))
-    else:
-        # TODO: Load custom noise file?
-        return clip
-    
-    
-    sig_power = np.sum(clip ** 2) / len(clip)
-    noise_power = np.sum(noise ** 2) / len(noise)
-    scale = (sig_power / noise_power) / (10 ** (snr / 10))
-    noise = noise * np.sqrt(scale)
+def get_random_clip(full_clip, sr, clip_length, silence_threshold=0.01, max_attempts=10, rng=None):
+    rng = rng if rng is not None else _rng
     
-    return clip + noise
-
-def random_slice_reassemble(audio_segment, num_slices=4):
-    slice_length = len(audio_segment) // num_slices
-    slices = [audio_segment[i * slice_length:(i + 1) * slice_length] for i in range(num_slices)]
-    random.shuffle(slices)
-    return sum(slices)
-
-def vary_speed(clip, sr, min_speed=0.9, max_speed=1.1):
-    speed_factor = random.uniform(min_speed, max_speed)
-    return librosa.effects.time_stretch(clip, rate=speed_factor)
-
-def get_random_clip(full_clip, sr, clip_length, silence_threshold=0.01, max_attempts=10):
     # If the full clip is shorter than the desired length, return the full clip
     if len(full_clip) <= sr * clip_length:
         return full_clip
 
     for _ in range(max_attempts):
-        start = random.randint(0, len(full_clip) - sr * clip_length)
+        start = rng.randint(0, len(full_clip) - sr * clip_length)
         clip = full_clip[start : start + sr * clip_length]
         
         # If the maximum absolute value in the clip is above the threshold, return the clip
@@ -222,63 +266,65 @@ def get_random_clip(full_clip, sr, clip_length, silence_threshold=0.01, max_atte
     # If no non-silent clip was found after max_attempts, return None
     return None
 
-def mix_clips_from_different_ranges(df, genre_instruments, output_file_name, sr=44100, clip_length=3, min_groups=3, max_groups=8):
-    # Randomly select a genre
-    genre = random.choice(list(genre_instruments.keys()))
-    instruments = genre_instruments[genre]
+def mix_clips_from_different_ranges(sampling_index, output_file_name, sr=44100, clip_length=3, min_groups=3, max_groups=8, audio_store=None, augmenter=None,
+                                    rng=None, np_rng=None):
+    labels, genre, mixed_clip = mix_sources(sampling_index, sr, clip_length, min_groups, max_groups, audio_store, augmenter,
+                                            rng=rng, np_rng=np_rng)
+    output_path = f"{output_file_name}.wav"
+    sf.write(output_path, mixed_clip, sr)
 
-    # Filter df for the selected instruments
-    df_genre = df[df['label'].isin(instruments)]
+    return labels, genre, output_path
 
-    grouped = df_genre.groupby('frequency_range')  # Group the clips by frequency range
-    num_groups = random.randint(min_groups, max_groups)
-    selected_groups = random.sample(list(grouped.groups), min(num_groups, len(grouped.groups)))
+def mix_sources(sampling_index, sr=44100, clip_length=3, min_groups=3, max_groups=8, audio_store=None, augmenter=None,
+                rng=None, np_rng=None):
+    # Returns the labels, the genre and the mixed audio, without writing anything. rng (a random.Random)
+    # and np_rng (a numpy RandomState) make every random choice, the module's generators by default
+    rng = rng if rng is not None else _rng
+    np_rng = np_rng if np_rng is not None else _np_rng
+    
+    # Randomly select a genre
+    genre = rng.choice(sampling_index.genres())
+
+    # Frequency ranges that have clips of the genre's instruments
+    bands = sampling_index.bands(genre)
+    num_groups = rng.randint(min_groups, max_groups)
+    selected_groups = rng.sample(bands, min(num_groups, len(bands)))
 
     selected_clips = []
     used_instruments = set()
     for group in selected_groups:
-        group_df = grouped.get_group(group)
-        group_df = group_df[~group_df['label'].isin(used_instruments)]  # Exclude used instruments
-        if not group_df.empty:
-            selected_clip = group_df.sample(1).iloc[0]
-            selected_clips.append(selected_clip)
-            used_instruments.add(selected_clip['label'])
+        source_id = sampling_index.sample(genre, group, exclude=used_instruments, rng=np_rng)  # Exclude used instruments
+        if source_id is not None:
+            selected_clips.append(source_id)
+            used_instruments.add(sampling_index.labels[source_id])
 
     mixed_clip = np.zeros(int(sr * clip_length))
 
-    for row in selected_clips:
-        full_clip, _ = librosa.load(row['path'], sr=sr)
+    clips = []
+    for source_id in selected_clips:
+        full_clip = load_clip(sampling_index.paths[source_id], sr=sr, audio_store=audio_store)
     
         # Randomly select a non-silent portion of the clip
-        clip = get_random_clip(full_clip, sr, clip_length)
-        if clip is None:
-            continue
-        
-        clip = adjust_for_genre(clip, genre)  # Add genre-specific adjustments
-        
-        # Randomly vary the speed of the clip
-        if random.random() < 0.5:
-            clip = vary_speed(clip, sr=sr)
-        
-        #Randomly slice and reassemble the clip
-        if random.random() < 0.3:
-            clip = random_slice_reassemble(clip)
-        
-        # Randomly add noise
-        if random.random() < 0.5:  # Chance of adding noise
-            noise_types = ['white', 'pink', 'custom', 'brownian']
-            noise_type = random.choice(noise_types)  # Randomly select the type of noise to add
-            clip = add_noise(clip, noise_type=noise_type)
-        
+        clip = get_random_clip(full_clip, sr, clip_length, rng=rng)
+        if clip is not None:
+            clips.append(clip)
+    
+    # Genre-specific adjustments, speed variation, slicing and noise for all clips of the mix at once
+    if augmenter is None:
+        augmenter = _default_augmenter()
+    clips = augmenter.apply(clips, genre, rng=np_rng)
+    
+    for clip in clips:
         if len(clip) < len(mixed_clip):
             clip = np.tile(clip, int(np.ceil(len(mixed_clip) / len(clip))))[:len(mixed_clip)]
         mixed_clip += clip[:len(mixed_clip)]
         
-    mixed_clip = mixed_clip / np.max(np.abs(mixed_clip))
-    output_path = f"{output_file_name}.wav"
-    sf.write(output_path, mixed_clip, sr)
+    # Normalize the mix, an empty mix stays silent
+    peak = np.max(np.abs(mixed_clip))
+    if peak > 0:
+        mixed_clip = mixed_clip / peak
 
-    return [row['label'] for row in selected_clips], genre, output_path
+    return [str(sampling_index.labels[source_id]) for source_id in selected_clips], genre, mixed_clip
 
 if __name__ == '__main__':
     
@@ -290,27 +336,48 @@ if __name__ == '__main__':
 
     DATA_DIR = project_root / 'data' / 'external'
     
-    # read metadata
-    meta = pd.read_csv(DATA_DIR / 'metadata.csv')
+    CATALOG_DIR = DATA_DIR / 'catalog'
 
-    # Check if 'frequency_range' column exists, if not, make it
-    if 'frequency_range' not in meta.columns:
-        tqdm.pandas(desc="Determining frequency ranges")
-        meta.loc[:, 'frequency_range'] = meta['path'].progress_apply(determine_frequency_range)
-        
-        # save updated metadata
-        meta.to_csv(DATA_DIR / 'metadata.csv', index=False)
-        
+    # Older downloads only have metadata.csv, convert it to a catalog once
+    if not catalog_exists(CATALOG_DIR):
+        save_catalog(add_audio_info(pd.read_csv(DATA_DIR / 'metadata.csv')), CATALOG_DIR)
+
+    # read metadata
+    meta = load_catalog(CATALOG_DIR)
+    
+    # Decode every source clip once, the frequency ranges and the mixer read from this store
+    audio_store = build_audio_store(meta, DATA_DIR / 'audio_store')
+
+    # Check if the band energy columns exist, if not, profile every clip once and add them
+    # together with the dominant 'frequency_range' to the catalog. Clips added to the catalog
+    # since the last run have no band energies yet, only those are profiled
+    if not set(BAND_ENERGY_COLUMNS + ['frequency_range']).issubset(meta.columns):
+        meta = meta.assign(**{column: np.nan for column in BAND_ENERGY_COLUMNS}, frequency_range=None)
+    unprofiled = meta[BAND_ENERGY_COLUMNS].isna().all(axis=1)
     
+    if unprofiled.any():
+        profile = profile_frequency_bands(meta[unprofiled], audio_store=audio_store, n_workers=os.cpu_count())
+        meta['frequency_range'] = meta['frequency_range'].astype(object)
+        meta.loc[unprofiled, profile.columns] = profile
+        add_columns(CATALOG_DIR, meta[profile.columns])
+        meta = load_catalog(CATALOG_DIR)
 
     PATH = project_root / 'data' / 'processed' / 'mixed_audio_clips'
     
     n_clips = 30000
     
-    mixed_clips_df = generate_mixed_audio_clips(meta, PATH, n_clips)
+    # Noise buffers are generated on the first run and memory-mapped by every worker after that.
+    # Noise recordings can be added with noise_bank.register(name, path), they are used as 'custom' noise
+    noise_bank = NoiseBank(DATA_DIR / 'noise_bank')
+    
+    # The spectrograms are computed straight from the mixes, set write_wav=True to also get the
+    # mixes as WAVs for listening or debugging
+    mixed_clips_df = generate_mixed_audio_clips(meta, PATH, n_clips, n_workers=os.cpu_count(), seed=42,
+                                                audio_store=audio_store, noise_bank=noise_bank,
+                                                spectrogram_dir=PATH / 'spectrograms', write_wav=False)
     
-    # Save mixed_clips_df to a CSV file
-    mixed_clips_df.to_csv(os.path.join(PATH, 'mixed_clips_df.csv'), index=False)
+    # Save mixed_clips_df as the catalog of the mixed clips
+    save_catalog(mixed_clips_df, PATH / 'catalog')
     
     
     
\ No newline at end of file
@@ -0,0 +1,96 @@
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.features.augment import AugmentationEngine
+from src.features.mix_audio_clips import mix_sources
+from src.features.spectrogram import SPECTROGRAM_PARAMS, normalized_log_mel, fixed_length
+
+
+class MixedClipStream(IterableDataset):
+    # Endless stream of mixes made on the fly with mix_sources, the same genre and frequency band
+    # logic as generate_mixed_audio_clips, but nothing is written to disk. Every item is a
+    # (spectrogram, target) pair of tensors: the normalized log-mel of the mix with shape
+    # (1, n_mels, n_frames), like the 'array' spectrograms, and a multi-hot float vector over vocab.
+    #
+    # Each data loader worker draws its own mixes. With a seed, the mixes depend on the seed, the
+    # epoch and the worker id, and next_epoch() moves on to new ones. Without a seed every pass
+    # over the stream gets fresh mixes
+    def __init__(self, sampling_index, audio_store=None, vocab=None, n_clips=30000, sr=44100, clip_length=3,
+                 noise_bank=None, seed=None, spectrogram_params=SPECTROGRAM_PARAMS):
+        if spectrogram_params['sr'] != sr:
+            raise ValueError(f"Spectrograms are computed at sr={spectrogram_params['sr']}, can't mix at sr={sr}")
+        self.sampling_index = sampling_index
+        self.audio_store = audio_store
+        # Every instrument the mixer can pick, sorted like a fastai MultiCategoryBlock vocab
+        self.vocab = list(vocab) if vocab is not None else sorted(set(map(str, sampling_index.labels[sampling_index.ids])))
+        self.n_clips = n_clips
+        self.sr = sr
+        self.clip_length = clip_length
+        self.noise_bank = noise_bank
+        self.seed = seed
+        self.spectrogram_params = spectrogram_params
+        self.epoch = 0
+        self._label_ids = {label: i for i, label in enumerate(self.vocab)}
+        self._augmenter = None
+
+    @property
+    def c(self):
+        return len(self.vocab)
+
+    def __len__(self):
+        # Mixes per epoch, the data loader stops after this many
+        return self.n_clips
+
+    def __getstate__(self):
+        # Every process builds its own augmenter, the noise bank itself is shared
+        state = self.__dict__.copy()
+        state['_augmenter'] = None
+        return state
+
+    @property
+    def augmenter(self):
+        if self._augmenter is None:
+            self._augmenter = AugmentationEngine(self.noise_bank)
+        return self._augmenter
+
+    def next_epoch(self):
+        self.epoch += 1
+
+    def new_empty(self):
+        # What a learner keeps when it is exported: the vocab, no audio
+        return type(self)(None, vocab=self.vocab, n_clips=0, sr=self.sr, clip_length=self.clip_length,
+                          spectrogram_params=self.spectrogram_params)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+
+        # The seed of every mix comes from one sequence per epoch and worker, with seed=None the
+        # sequence starts from fresh entropy
+        seeds = np.random.SeedSequence(self.seed, spawn_key=(self.epoch, worker_id))
+        while True:
+            clip_seed = int(seeds.spawn(1)[0].generate_state(1)[0])
+            item = self.mix(clip_seed)
+            if item is not None:
+                yield item
+
+    def mix(self, clip_seed):
+        # Both random generators of the mixing and augmentation code start from the clip's seed, like _mix_clip
+        labels, _, mixed_clip = mix_sources(self.sampling_index, self.sr, self.clip_length,
+                                            audio_store=self.audio_store, augmenter=self.augmenter,
+                                            rng=random.Random(clip_seed), np_rng=np.random.RandomState(clip_seed))
+        self.augmenter.pop_timings()
+        if not labels:
+            return None
+
+        params = self.spectrogram_params
+        spec = normalized_log_mel(fixed_length(mixed_clip, int(self.clip_length * self.sr), seed=clip_seed), params)
+        # A silent mix normalizes to NaN, which would turn the loss into NaN too
+        spec = np.nan_to_num(spec, nan=0.0)
+
+        target = torch.zeros(len(self.vocab))
+        target[[self._label_ids[label] for label in labels]] = 1
+        return torch.from_numpy(spec.astype(np.float32))[None], target
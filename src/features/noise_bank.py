@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import colorednoise as cn
+
+from src.features.audio_store import load_clip
+
+# Power law exponents of the generated noise colours
+NOISE_BETAS = {'white': 0, 'pink': 1, 'brownian': 2}
+
+# Registered recordings are stored next to the generated buffers as custom_<name>.f32
+CUSTOM_PREFIX = 'custom_'
+
+
+class NoiseBank:
+    # Long noise buffers synthesized once, clips get a window at a random offset instead of
+    # generating fresh noise of their own length every time. With a bank_dir the buffers are written
+    # there as raw float32 files the first time and memory-mapped after that, so every worker process
+    # shares one copy. Noise recordings added with register() are drawn as the 'custom' noise type
+    def __init__(self, bank_dir=None, length=2**21, seed=0):
+        self.bank_dir = Path(bank_dir) if bank_dir is not None else None
+        self.length = length
+        self.seed = seed
+        self.buffers = {}
+        self._load()
+
+    def _load(self):
+        if self.bank_dir is not None:
+            self.bank_dir.mkdir(parents=True, exist_ok=True)
+
+        rng = np.random.RandomState(self.seed)
+        for name, beta in NOISE_BETAS.items():
+            # Draw the seed even when the buffer is already on disk, so the buffers don't depend on which exist
+            noise_seed = rng.randint(2**31)
+            path = self.bank_dir / f'{name}.f32' if self.bank_dir is not None else None
+            if path is not None and path.exists() and os.path.getsize(path) == self.length * 4:
+                self.buffers[name] = np.memmap(path, dtype=np.float32, mode='r')
+                continue
+            noise = cn.powerlaw_psd_gaussian(beta, self.length, random_state=noise_seed)
+            self.buffers[name] = self._store(name, noise)
+
+        if self.bank_dir is not None:
+            for path in sorted(self.bank_dir.glob(f'{CUSTOM_PREFIX}*.f32')):
+                self.buffers[path.stem] = np.memmap(path, dtype=np.float32, mode='r')
+
+    def _store(self, name, noise):
+        # Unit power, the SNR scaling then only depends on the window
+        noise = (noise / np.sqrt(np.mean(noise ** 2))).astype(np.float32)
+        if self.bank_dir is None:
+            return noise
+
+        # Write to a temporary name first, so a crash never leaves a truncated buffer behind
+        path = self.bank_dir / f'{name}.f32'
+        tmp_path = path.with_name(path.name + '.tmp')
+        noise.tofile(tmp_path)
+        os.replace(tmp_path, path)
+        return np.memmap(path, dtype=np.float32, mode='r')
+
+    def __getstate__(self):
+        # Memory-mapped buffers are opened again by the receiving process instead of being copied
+        state = self.__dict__.copy()
+        if self.bank_dir is not None:
+            state['buffers'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.buffers is None:
+            self.buffers = {}
+            self._load()
+
+    @property
+    def custom_names(self):
+        return [name for name in self.buffers if name.startswith(CUSTOM_PREFIX)]
+
+    def register(self, name, audio, sr=44100):
+        # Adds a noise recording, given as a file path or as samples at sr, under 'custom_<name>'
+        if isinstance(audio, (str, Path)):
+            audio = load_clip(audio, sr=sr)
+        audio = np.asarray(audio, dtype=np.float32)
+        if not len(audio) or not np.any(audio):
+            raise ValueError(f"Noise recording {name} is silent")
+        name = name if name.startswith(CUSTOM_PREFIX) else CUSTOM_PREFIX + name
+        self.buffers[name] = self._store(name, audio)
+        return name
+
+    def __contains__(self, noise_type):
+        if noise_type == 'custom':
+            return bool(self.custom_names)
+        return noise_type in self.buffers
+
+    def draw(self, noise_type, length, rng=np.random):
+        # 'custom' picks one of the registered recordings
+        if noise_type == 'custom':
+            custom_names = self.custom_names
+            noise_type = custom_names[rng.randint(len(custom_names))]
+        buffer = self.buffers[noise_type]
+        if length > len(buffer):
+            buffer = np.tile(buffer, int(np.ceil(length / len(buffer))))
+        start = rng.randint(len(buffer) - length + 1)
+        return buffer[start:start + length]
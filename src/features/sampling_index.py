@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+
+
+class SamplingIndex:
+    # Source clips grouped by genre -> frequency band -> instrument, so the mixer can draw clips
+    # with integer sampling instead of filtering the metadata for every mix. The ids of a group are
+    # one contiguous slice of `ids`, and an id is a row position in `paths` and `labels`.
+    # Plain arrays and dicts only, so it pickles cheaply to worker processes and saves to one .npz
+    def __init__(self, paths, labels, ids, groups):
+        self.paths = paths
+        self.labels = labels
+        self.ids = ids
+        # {genre: {band: (instruments, starts, counts)}}, bands and instruments sorted by name
+        self.groups = groups
+
+    @classmethod
+    def from_frame(cls, df, genre_instruments):
+        df = df[df['frequency_range'].notna() & df['label'].notna()]
+        paths = np.asarray(df['path'].astype(str).tolist(), dtype=str)
+        labels = np.asarray(df['label'].astype(str).tolist(), dtype=str)
+        bands = np.asarray(df['frequency_range'].astype(str).tolist(), dtype=str)
+
+        ids = []
+        n_ids = 0
+        groups = {}
+        for genre, instruments in genre_instruments.items():
+            in_genre = np.isin(labels, instruments)
+            genre_groups = {}
+            for band in sorted(set(bands[in_genre])):
+                in_band = in_genre & (bands == band)
+                band_instruments = sorted(set(labels[in_band]))
+                starts, counts = [], []
+                for instrument in band_instruments:
+                    members = np.flatnonzero(in_band & (labels == instrument))
+                    starts.append(n_ids)
+                    counts.append(len(members))
+                    ids.append(members)
+                    n_ids += len(members)
+                genre_groups[band] = (band_instruments, np.array(starts, dtype=np.int64), np.array(counts, dtype=np.int64))
+            groups[genre] = genre_groups
+
+        ids = np.concatenate(ids).astype(np.int32) if ids else np.zeros(0, dtype=np.int32)
+        return cls(paths, labels, ids, groups)
+
+    def genres(self):
+        return list(self.groups)
+
+    def bands(self, genre):
+        return list(self.groups[genre])
+
+    def sample(self, genre, band, exclude=(), rng=np.random):
+        # Draws one source id from the band, uniformly over the clips of the instruments not in exclude.
+        # Returns None when every instrument in the band is excluded
+        instruments, starts, counts = self.groups[genre][band]
+        counts = np.where(np.isin(instruments, list(exclude)), 0, counts) if exclude else counts
+        total = counts.sum()
+        if total == 0:
+            return None
+        r = rng.randint(total)
+        ends = np.cumsum(counts)
+        i = int(np.searchsorted(ends, r, side='right'))
+        return int(self.ids[starts[i] + r - (ends[i] - counts[i])])
+
+    def save(self, path):
+        groups = {genre: {band: (instruments, starts.tolist(), counts.tolist())
+                          for band, (instruments, starts, counts) in bands.items()}
+                  for genre, bands in self.groups.items()}
+        np.savez(path, paths=self.paths, labels=self.labels, ids=self.ids, groups=json.dumps(groups))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            groups = {genre: {band: (instruments, np.array(starts, dtype=np.int64), np.array(counts, dtype=np.int64))
+                              for band, (instruments, starts, counts) in bands.items()}
+                      for genre, bands in json.loads(str(f['groups'])).items()}
+            return cls(f['paths'], f['labels'], f['ids'], groups)
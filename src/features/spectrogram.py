@@ -0,0 +1,87 @@
+from functools import lru_cache
+from collections import defaultdict
+
+import numpy as np
+import librosa
+from matplotlib import cm
+
+# Parameters that determine the content of a spectrogram. Training data and the app both use these,
+# so the model sees the same features in both
+SPECTROGRAM_PARAMS = {'sr': 44100, 'n_mels': 128, 'fmax': 22000, 'hop_length': 512}
+N_FFT = 2048
+
+# Settings of librosa.power_to_db(S, ref=np.max)
+AMIN = 1e-10
+TOP_DB = 80.0
+
+
+@lru_cache(maxsize=None)
+def stft_window(n_fft=N_FFT):
+    return librosa.filters.get_window('hann', n_fft, fftbins=True)
+
+
+@lru_cache(maxsize=None)
+def mel_basis(sr=44100, n_fft=N_FFT, n_mels=128, fmax=22000):
+    # Built once per process instead of on every melspectrogram call
+    basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmax=fmax)
+    basis.flags.writeable = False
+    return basis
+
+
+@lru_cache(maxsize=None)
+def _viridis_lut():
+    # The 256 colours matplotlib picks from, so colorize gives the same pixels as cm.viridis
+    return (cm.viridis(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+
+def stft(y, n_fft=N_FFT, hop_length=512):
+    # Complex STFT of one signal or of a (N, samples) stack, shape (..., 1 + n_fft // 2, n_frames)
+    return librosa.stft(y, n_fft=n_fft, hop_length=hop_length, window=stft_window(n_fft))
+
+
+def mel_power(y, params=SPECTROGRAM_PARAMS, n_fft=N_FFT):
+    # Mel power spectrogram, the same as librosa.feature.melspectrogram with these params
+    S = np.abs(stft(y, n_fft, params['hop_length'])) ** 2
+    return np.matmul(mel_basis(params['sr'], n_fft, params['n_mels'], params['fmax']), S)
+
+
+def normalized_log_mel(y, params=SPECTROGRAM_PARAMS):
+    # Log-mel of each signal relative to its own peak (power_to_db with ref=np.max), scaled to 0..1
+    S = mel_power(y, params)
+    log_spec = 10.0 * np.log10(np.maximum(AMIN, S))
+    log_spec -= 10.0 * np.log10(np.maximum(AMIN, S.max(axis=(-2, -1), keepdims=True)))
+    log_spec = np.maximum(log_spec, log_spec.max(axis=(-2, -1), keepdims=True) - TOP_DB)
+
+    low = log_spec.min(axis=(-2, -1), keepdims=True)
+    high = log_spec.max(axis=(-2, -1), keepdims=True)
+    return (log_spec - low) / (high - low)
+
+
+def fixed_length(y, n_samples, seed=None):
+    # Pads y with silence at a random offset, or truncates it, to n_samples
+    if len(y) >= n_samples:
+        return y[:n_samples]
+    padding_needed = n_samples - len(y)
+    offset = np.random.RandomState(seed).randint(0, padding_needed)
+    return np.concatenate((np.zeros(offset), y, np.zeros(padding_needed - offset)))
+
+
+def colorize(norm_log_mel_spec):
+    # Viridis RGB image(s) of normalized spectrograms, uint8 of shape (..., n_mels, n_frames, 3)
+    index = np.clip((np.nan_to_num(norm_log_mel_spec, nan=0.0) * 256).astype(np.int64), 0, 255)
+    rgb = _viridis_lut()[index]
+    # matplotlib draws NaN (a silent spectrogram) as transparent black
+    rgb[np.isnan(norm_log_mel_spec)] = 0
+    return rgb
+
+
+def batched(signals, fn):
+    # Applies fn to stacks of equal-length signals and returns the results in the original order
+    results = [None] * len(signals)
+    by_length = defaultdict(list)
+    for i, y in enumerate(signals):
+        by_length[len(y)].append(i)
+    for indices in by_length.values():
+        for i, result in zip(indices, fn(np.stack([signals[i] for i in indices]))):
+            results[i] = result
+    return results
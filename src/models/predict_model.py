@@ -0,0 +1,119 @@
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+import imageio
+from fastcore.basics import getcallable
+from fastai.data.transforms import RandomSplitter
+
+# Probabilities above this count as a predicted label, the same threshold as the app
+THRESHOLD = 0.1
+
+
+class ScriptedModel:
+    # A model written by export_model: a TorchScript graph with the preprocessing and the activation
+    # built in, loaded without fastai. config['input'] says whether it takes the RGB spectrogram
+    # images of the app ('rgb') or single channel log-mels ('log_mel')
+    def __init__(self, path):
+        extra_files = {'vocab.json': '', 'config.json': ''}
+        self.module = torch.jit.load(str(path), map_location='cpu', _extra_files=extra_files)
+        self.module.eval()
+        self.vocab = json.loads(extra_files['vocab.json'])
+        self.config = json.loads(extra_files['config.json'])
+
+    def predict_batch(self, spectrograms, batch_size=16):
+        # Returns the (N, len(vocab)) probabilities. Spectrograms of equal shape are stacked, so the
+        # shorter last segment of a song goes through on its own
+        probs = [None] * len(spectrograms)
+        with torch.inference_mode():
+            for start in range(0, len(spectrograms), batch_size):
+                by_shape = defaultdict(list)
+                for i in range(start, min(start + batch_size, len(spectrograms))):
+                    by_shape[np.shape(spectrograms[i])].append(i)
+                for indices in by_shape.values():
+                    x = torch.from_numpy(np.stack([np.asarray(spectrograms[i]) for i in indices]))
+                    for i, p in zip(indices, self.module(x)):
+                        probs[i] = p
+        return torch.stack(probs) if probs else torch.zeros(0, len(self.vocab))
+
+
+def predict_with_learner(learn, items, batch_size=16):
+    # The fastai path of the app: the learner's test DataLoader and the activation of the loss function
+    dl = learn.dls.test_dl(items, bs=batch_size, num_workers=0)
+    activation = getcallable(learn.loss_func, 'activation')
+    learn.model.eval()
+    probs = []
+    with torch.inference_mode():
+        for xb, in dl:
+            probs.append(activation(learn.model(xb)))
+    return torch.cat(probs).cpu()
+
+
+def held_out_set(metadata, vocab, input_kind='rgb', n=None, valid_pct=0.2, seed=420):
+    # The validation rows of train_model's RandomSplitter, which the model hasn't trained on. Returns
+    # the items for the learner's test_dl, the inputs of the exported model and the multi-hot targets
+    _, valid_idx = RandomSplitter(valid_pct, seed)(metadata)
+    rows = metadata.iloc[list(valid_idx)[:n]].reset_index(drop=True)
+
+    if input_kind == 'rgb':
+        if 'spectrogram_index' in rows.columns:
+            raise ValueError("The held-out set has array spectrograms, an RGB model needs the PNGs")
+        inputs = [imageio.imread(path)[..., :3] for path in rows['spectrogram_path']]
+        items = inputs
+    else:
+        arrays = {}
+        inputs = []
+        for path, index in zip(rows['spectrogram_path'], rows['spectrogram_index']):
+            if path not in arrays:
+                arrays[path] = np.load(path, mmap_mode='r')
+            inputs.append(np.asarray(arrays[path][int(index)]))
+        items = rows
+
+    label_ids = {label: i for i, label in enumerate(vocab)}
+    targets = torch.zeros(len(rows), len(vocab))
+    for i, labels in enumerate(rows['labels']):
+        targets[i, [label_ids[label] for label in labels.split(', ') if label in label_ids]] = 1
+    return items, inputs, targets
+
+
+def compare_with_learner(learn, model, items, inputs, targets, batch_size=16, threshold=THRESHOLD):
+    # Latency and accuracy of the exported model next to the fastai path on the same held-out set
+    backends = {
+        'fastai': (lambda batch: predict_with_learner(learn, batch, batch_size), items),
+        'torchscript': (lambda batch: model.predict_batch(batch, batch_size), inputs),
+    }
+    report = {}
+    all_probs = {}
+    for name, (predict, data) in backends.items():
+        # One untimed batch first, so lazy initialisation doesn't count
+        predict(data[:batch_size])
+        probs, timings = [], []
+        for start in range(0, len(data), batch_size):
+            batch_start = time.perf_counter()
+            probs.append(predict(data[start:start + batch_size]))
+            timings.append(time.perf_counter() - batch_start)
+        probs = torch.cat(probs)
+        preds = (probs > threshold).float()
+        all_probs[name] = probs
+        report[name] = {
+            'ms_per_segment': 1000 * sum(timings) / len(data),
+            'p50_batch_ms': float(1000 * np.percentile(timings, 50)),
+            'accuracy': float((preds == targets).float().mean()),
+            'exact_match': float((preds == targets).all(dim=1).float().mean()),
+        }
+
+    report['label_agreement'] = float(((all_probs['fastai'] > threshold) == (all_probs['torchscript'] > threshold))
+                                      .all(dim=1).float().mean())
+    report['max_abs_prob_diff'] = float((all_probs['fastai'] - all_probs['torchscript']).abs().max())
+    report['speedup'] = report['fastai']['ms_per_segment'] / report['torchscript']['ms_per_segment']
+
+    print(f"Held-out segments: {len(targets)}")
+    for name in backends:
+        r = report[name]
+        print(f"  {name:<12}{r['ms_per_segment']:8.2f} ms/segment  p50 batch {r['p50_batch_ms']:8.1f} ms  "
+              f"accuracy {r['accuracy']:.4f}  exact match {r['exact_match']:.4f}")
+    print(f"  Speedup {report['speedup']:.2f}x, same labels on {report['label_agreement']:.2%} of the segments, "
+          f"max probability difference {report['max_abs_prob_diff']:.4f}")
+    return report
@@ -1,21 +1,37 @@
 import os
+import json
+import argparse
 from pathlib import Path
 
 import pandas as pd
 
 from fastai.vision.all import *
+# After the star import, which has a function called copy
+import copy
 from torch.nn import BCEWithLogitsLoss
+import torch.nn.functional as F
 from sklearn.metrics import precision_recall_fscore_support
 import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime
 
+from src.data.catalog import catalog_exists, load_catalog
+from src.features.audio_store import AudioStore
+from src.features.sampling_index import SamplingIndex
+from src.features.noise_bank import NoiseBank
+from src.features.mix_stream import MixedClipStream
+from src.features.mix_audio_clips import GENRE_INSTRUMENTS
+from src.features.spectrogram import SPECTROGRAM_PARAMS
+from src.models.predict_model import ScriptedModel, held_out_set, compare_with_learner
+
 
 def check_for_df(directory):
-    if os.path.isfile(directory / 'mixed_clips_df.csv'):
+    if catalog_exists(directory / 'catalog'):
+        return load_catalog(directory / 'catalog')
+    elif os.path.isfile(directory / 'mixed_clips_df.csv'):
         return pd.read_csv(directory / 'mixed_clips_df.csv')
     else:
-        print("No mixed_clips_df.csv file found in the directory. Please run the data preprocessing scripts first.")
+        print("No catalog found in the directory. Please run the data preprocessing scripts first.")
         return None
     
 def get_y(r): 
@@ -24,20 +40,85 @@ def get_y(r):
 def get_x(r): 
     return r['spectrogram_path']
 
+
+# Spectrogram arrays are memory-mapped once per process and shared by all items
+_spectrogram_arrays = {}
+
+def load_spectrogram(r):
+    path = r['spectrogram_path']
+    if path not in _spectrogram_arrays:
+        _spectrogram_arrays[path] = np.load(path, mmap_mode='r')
+    
+    # Single channel float tensor of shape (1, n_mels, n_frames)
+    spec = _spectrogram_arrays[path][r['spectrogram_index']]
+    return TensorImage(torch.from_numpy(spec.astype(np.float32))[None])
+
+def SpectrogramArrayBlock():
+    # Reads log-mel arrays written by generate_spectrograms(output_format='array'), no decoding or resizing
+    return TransformBlock(type_tfms=load_spectrogram)
+
+    
+def train_model(metadata, directory, model_name, spectrogram_format=None):
+    # Spectrograms stored as arrays come with a 'spectrogram_index' column
+    if spectrogram_format is None:
+        spectrogram_format = 'array' if 'spectrogram_index' in metadata.columns else 'png'
     
-def train_model(metadata, directory, model_name):
-    # Create a DataBlock
-    db = DataBlock(blocks=(ImageBlock, MultiCategoryBlock),
-                splitter=RandomSplitter(seed=420),
-                get_x=get_x,
-                get_y=get_y,
-                item_tfms=[Resize(224)],  # Resize all images to 224x224
-                )
+    if spectrogram_format == 'array':
+        # Rows are passed to load_spectrogram as they are
+        db = DataBlock(blocks=(SpectrogramArrayBlock, MultiCategoryBlock),
+                    splitter=RandomSplitter(seed=420),
+                    get_y=get_y,
+                    )
+        n_in = 1
+    else:
+        # Create a DataBlock
+        db = DataBlock(blocks=(ImageBlock, MultiCategoryBlock),
+                    splitter=RandomSplitter(seed=420),
+                    get_x=get_x,
+                    get_y=get_y,
+                    item_tfms=[Resize(224)],  # Resize all images to 224x224
+                    )
+        n_in = 3
 
     dls = db.dataloaders(metadata, bs=64)
     
+    return fit_and_save(dls, n_in, directory, model_name)
+
+
+class StreamDataLoader(DataLoader):
+    # Moves the stream on to new mixes every time the loader is iterated. The workers get a copy
+    # of the dataset when the iteration starts, so the epoch has to be advanced here
+    def before_iter(self):
+        super().before_iter()
+        self.dataset.next_epoch()
+
+
+def stream_dataloaders(sampling_index, audio_store, n_clips=30000, n_valid=3000, bs=64, n_workers=None,
+                       noise_bank=None, seed=None):
+    # Training mixes are made on the fly by the loader workers and are new every epoch. The
+    # validation mixes come from a fixed seed, so every epoch is validated on the same mixes
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    train_ds = MixedClipStream(sampling_index, audio_store, n_clips=n_clips, noise_bank=noise_bank, seed=seed)
+    valid_ds = MixedClipStream(sampling_index, audio_store, vocab=train_ds.vocab, n_clips=n_valid,
+                               noise_bank=noise_bank, seed=420)
+    
+    train_dl = StreamDataLoader(train_ds, bs=bs, num_workers=n_workers, drop_last=True)
+    valid_dl = DataLoader(valid_ds, bs=bs, num_workers=n_workers)
+    return DataLoaders(train_dl, valid_dl, device=default_device())
+
+
+def train_streaming_model(sampling_index, audio_store, directory, model_name, n_clips=30000, n_valid=3000,
+                          n_workers=None, noise_bank=None, seed=None):
+    # Trains on single channel log-mels like the 'array' format, without any mixes on disk
+    dls = stream_dataloaders(sampling_index, audio_store, n_clips=n_clips, n_valid=n_valid, n_workers=n_workers,
+                             noise_bank=noise_bank, seed=seed)
+    return fit_and_save(dls, 1, directory, model_name)
+
+
+def fit_and_save(dls, n_in, directory, model_name):
     learn = vision_learner(dls, 
                            resnet34, 
+                           n_in=n_in,
                            metrics=partial(accuracy_multi, thresh=0.5), 
                            loss_func=BCEWithLogitsLoss()
                            )
@@ -61,21 +142,146 @@ def save_model(learn, path):
     learn.export(path)
     print("Model saved successfully. Path: " + str(path))
 
+
+class _WithActivation(nn.Module):
+    # The model followed by the activation learn.predict applies to its output
+    def __init__(self, model, activation):
+        super().__init__()
+        self.model = model
+        self.activation = activation
+
+    def forward(self, x):
+        return self.activation(self.model(x))
+
+
+class _Preprocess(nn.Module):
+    # The fastai item and batch transforms of the learner as tensor ops, in front of the traced model.
+    # RGB models take the uint8 (N, n_mels, n_frames, 3) spectrogram images the app renders, and get
+    # the center crop and resize of Resize (torch's antialiased bilinear resize instead of Pillow's)
+    # and the Normalize of the learner. Single channel models take (N, n_mels, n_frames) log-mels
+    def __init__(self, model, rgb: bool, size, crop: bool, mean, std):
+        super().__init__()
+        self.model = model
+        self.rgb = rgb
+        self.resize = size is not None
+        # (height, width)
+        self.size = list(size) if size is not None else [0, 0]
+        self.crop = crop
+        self.normalize = mean is not None
+        self.register_buffer('mean', mean if mean is not None else torch.zeros(1))
+        self.register_buffer('std', std if std is not None else torch.ones(1))
+
+    def forward(self, x):
+        if not self.rgb:
+            return self.model(x.float().unsqueeze(1))
+
+        x = x.permute(0, 3, 1, 2).float() / 255.0
+        if self.resize:
+            if self.crop:
+                # Largest region with the aspect ratio of size, centered, like Resize on the validation set
+                h, w = x.shape[2], x.shape[3]
+                m = min(w / self.size[1], h / self.size[0])
+                crop_h, crop_w = int(m * self.size[0]), int(m * self.size[1])
+                top, left = int(0.5 * (h - crop_h)), int(0.5 * (w - crop_w))
+                x = x[:, :, top:top + crop_h, left:left + crop_w]
+            x = F.interpolate(x, size=(self.size[0], self.size[1]), mode='bilinear', align_corners=False, antialias=True)
+        if self.normalize:
+            x = (x - self.mean) / self.std
+        return self.model(x)
+
+
+def _inference_transforms(learn):
+    # Size and crop of the Resize item transform and the statistics of the Normalize batch transform
+    size, crop, mean, std = None, False, None, None
+    for tfm in learn.dls.after_item.fs:
+        if isinstance(tfm, Resize):
+            if tfm.method == ResizeMethod.Pad:
+                raise ValueError("Exporting a model trained with Resize(method='pad') is not supported")
+            size, crop = (tfm.size[1], tfm.size[0]), tfm.method == ResizeMethod.Crop
+    for tfm in learn.dls.after_batch.fs:
+        if isinstance(tfm, Normalize):
+            mean, std = tfm.mean.detach().cpu().float(), tfm.std.detach().cpu().float()
+    return size, crop, mean, std
+
+
+def export_model(learn, path, quantize=False):
+    # Writes the model as a TorchScript file that needs neither fastai nor the learner's transforms:
+    # the preprocessing and the output activation are part of the graph, and the vocab is stored in
+    # the file. With quantize the linear layers of the head get dynamic int8 weights, the convolutions
+    # of the body stay float
+    model = copy.deepcopy(learn.model).cpu().eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    
+    first_conv = next(m for m in model.modules() if isinstance(m, nn.Conv2d))
+    rgb = first_conv.in_channels == 3
+    size, crop, mean, std = _inference_transforms(learn) if rgb else (None, False, None, None)
+    
+    # Trace the model on what the preprocessing makes of a 3 second segment, the preprocessing
+    # itself is scripted so the width of the input can vary
+    n_frames = 1 + 3 * SPECTROGRAM_PARAMS['sr'] // SPECTROGRAM_PARAMS['hop_length']
+    example = (torch.zeros(1, SPECTROGRAM_PARAMS['n_mels'], n_frames, 3, dtype=torch.uint8) if rgb
+               else torch.zeros(1, SPECTROGRAM_PARAMS['n_mels'], n_frames))
+    preprocess = _Preprocess(nn.Identity(), rgb, size, crop, mean, std)
+    with torch.no_grad():
+        traced = torch.jit.trace(_WithActivation(model, getcallable(learn.loss_func, 'activation')),
+                                 preprocess(example), check_trace=False)
+    preprocess.model = traced
+    scripted = torch.jit.freeze(torch.jit.script(preprocess.eval()))
+    
+    config = {'input': 'rgb' if rgb else 'log_mel', 'quantized': quantize, 'spectrogram_params': SPECTROGRAM_PARAMS}
+    torch.jit.save(scripted, str(path), _extra_files={'vocab.json': json.dumps([str(v) for v in learn.dls.vocab]),
+                                                      'config.json': json.dumps(config)})
+    print("Model exported successfully. Path: " + str(path))
+    return path
+
     
 if __name__ == '__main__':
     PROJECT_ROOT = Path(__file__).resolve().parents[2]
     meta_directory = PROJECT_ROOT / 'data' / 'processed' / 'mixed_audio_clips'
     
-    metadata = check_for_df(meta_directory)
+    parser = argparse.ArgumentParser(description="Train the instrument classifier")
+    parser.add_argument('--streaming', action='store_true',
+                        help="mix the training clips on the fly from the audio store instead of reading the generated mixes")
+    parser.add_argument('--clips-per-epoch', type=int, default=30000, help="mixes per epoch in streaming mode")
+    parser.add_argument('--export', metavar='PKL', help="export a trained .pkl model to TorchScript instead of training")
+    parser.add_argument('--quantize', action='store_true', help="dynamic int8 quantization of the exported model")
+    parser.add_argument('--compare', type=int, default=500,
+                        help="held-out segments to compare the exported model with the learner on, 0 to skip")
+    args = parser.parse_args()
     
-    if metadata is not None:
-        print("Data preprocessing script has been run successfully. You can now train the model.")
-
-        directory = PROJECT_ROOT / 'models'
-        
-        model_name = 'resnet34'
+    if args.export:
+        learn = load_learner(args.export)
+        pkl_path = Path(args.export)
+        path = export_model(learn, pkl_path.with_name(pkl_path.stem + ('_int8' if args.quantize else '') + '.pt'),
+                            quantize=args.quantize)
         
-        learn = train_model(metadata,directory, model_name)
+        metadata = check_for_df(meta_directory) if args.compare else None
+        if metadata is not None:
+            model = ScriptedModel(path)
+            items, inputs, targets = held_out_set(metadata, model.vocab, model.config['input'], n=args.compare)
+            compare_with_learner(learn, model, items, inputs, targets)
+    
+    elif args.streaming:
+        # Needs the catalog with frequency ranges and the audio store built by mix_audio_clips.py
+        DATA_DIR = PROJECT_ROOT / 'data' / 'external'
+        meta = load_catalog(DATA_DIR / 'catalog')
+        sampling_index = SamplingIndex.from_frame(meta, GENRE_INSTRUMENTS)
         
+        learn = train_streaming_model(sampling_index, AudioStore(DATA_DIR / 'audio_store'), PROJECT_ROOT / 'models',
+                                      'resnet34', n_clips=args.clips_per_epoch, noise_bank=NoiseBank(DATA_DIR / 'noise_bank'))
+    
     else:
-        print("Please run the data preprocessing script before training the model.")
\ No newline at end of file
+        metadata = check_for_df(meta_directory)
+        
+        if metadata is not None:
+            print("Data preprocessing script has been run successfully. You can now train the model.")
+
+            directory = PROJECT_ROOT / 'models'
+            
+            model_name = 'resnet34'
+            
+            learn = train_model(metadata,directory, model_name)
+            
+        else:
+            print("Please run the data preprocessing script before training the model.")
\ No newline at end of file
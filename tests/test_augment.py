@@ -0,0 +1,34 @@
+import numpy as np
+
+from src.features.augment import AugmentationEngine
+from src.features.noise_bank import NoiseBank
+
+
+def _gappy_recording(n_silent, rng):
+    # A little noise at both ends of a long stretch of exact silence
+    return np.concatenate([rng.standard_normal(100), np.zeros(n_silent), rng.standard_normal(100)])
+
+
+def test_silent_noise_window_is_not_added():
+    rng = np.random.RandomState(0)
+    bank = NoiseBank(length=2**12)
+    bank.register('gappy', _gappy_recording(100000, rng))
+    engine = AugmentationEngine(bank)
+    clip = rng.standard_normal(1000).astype(np.float32)
+
+    # Nearly every window of the recording is silent
+    for seed in range(20):
+        noisy = engine._add_noise(clip, 'custom', 20, np.random.RandomState(seed))
+        assert np.isfinite(noisy).all()
+
+
+def test_mix_with_silent_noise_windows_stays_finite():
+    rng = np.random.RandomState(1)
+    bank = NoiseBank(length=2**12)
+    bank.register('gappy', _gappy_recording(100000, rng))
+    engine = AugmentationEngine(bank)
+    clips = [rng.standard_normal(4410).astype(np.float32) for _ in range(4)]
+
+    for seed in range(10):
+        for clip in engine.apply(clips, 'rock', rng=np.random.RandomState(seed)):
+            assert np.isfinite(clip).all()